@@ -1,30 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import hashlib
 import json
 import os
 import secrets
 from typing import Optional
 import uuid
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi import BackgroundTasks, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
 from authlib.integrations.starlette_client import OAuth, OAuthError
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
 from starlette.middleware.sessions import SessionMiddleware
-from openai import OpenAI
+from openai import AsyncOpenAI
 from pydantic import BaseModel, Field
 import redis
+import redis.asyncio as aioredis
 from app.services.client_agent.client_agent import ClientAgent
-from app.services.orchestrator.memory import ConversationManager
+from app.services.google_services.credential_cache import TokenRefreshScheduler, credential_cache
+from app.services.google_services.service_cache import service_cache
+from app.services.orchestrator.memory import ConversationManager, flush_pending_writes
 from app.services.user_manager import CredentialManager
-from app.utils.helper_funcs import execute_gmail_task, trigger_gmail_watch_service
+from app.utils.gmail_coalescer import GmailNotificationCoalescer
+from app.utils.helper_funcs import decode_gmail_notification, trigger_gmail_watch_service
+from app.utils.ingestion_queue import IngestionQueue, IngestionQueueFull
+from app.utils.supabase_pool import close_supabase_clients
+from app.utils.task_queue import dispatch_orchestrator_task
 from app.utils.websocket_manager import WebsocketManager
 
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # supabase calls run in the thread pool, bound it so a burst of requests can't spawn unlimited threads
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=API_THREADS))
+
+    # refresh google tokens before they expire so requests never wait on oauth
+    token_refresh_scheduler = TokenRefreshScheduler(CredentialManager(), redis_client=r)
+    if os.getenv("TOKEN_REFRESH_ENABLED", "true").lower() == "true":
+        token_refresh_scheduler.start()
+
+    yield
+
+    await asyncio.to_thread(token_refresh_scheduler.stop)
+    # write the buffered chat messages, anything left over stays staged in redis for the next start
+    await asyncio.to_thread(flush_pending_writes, 30)
+    await websocket_manager.close()
+    await openai_client.close()
+    await async_r.aclose()
+    # release the shared supabase connections
+    await close_supabase_clients()
+
+app = FastAPI(lifespan=lifespan)
 
 redis_host = os.getenv("REDIS_HOST", "localhost")
 
 r = redis.Redis(host=redis_host, port=6379, db=0)
 
+# used by the async endpoints so redis calls don't block the event loop
+async_r = aioredis.Redis(host=redis_host, port=6379, db=0)
+
+# one client (and connection pool) for every chat request
+openai_client = AsyncOpenAI()
+
+# threads for the blocking supabase calls made by the chat endpoints
+API_THREADS = int(os.getenv("API_THREADS", 32))
+
+# collapses bursts of gmail notifications for a user into a single ingestion run
+gmail_coalescer = GmailNotificationCoalescer(r)
+
+# mailboxes waiting for the ingestion worker
+ingestion_queue = IngestionQueue(r)
+
 # gmail_client = Gmail
 
 
@@ -124,6 +171,10 @@ async def gmail_auth(request: Request, background_tasks: BackgroundTasks):
             #add tokens to db
             credential_manager.add_google_tokens(user_id, token.get("access_token"), token.get('refresh_token'), token.get('expires_at'))
 
+            #the cached credentials and the services built with them have the old (maybe revoked) token
+            credential_cache.evict(user_id)
+            service_cache.evict_user(user_id)
+
             #add gmail watcher
             background_tasks.add_task(trigger_gmail_watch_service, credential_manager, user_id)
 
@@ -144,7 +195,7 @@ async def gmail_auth(request: Request, background_tasks: BackgroundTasks):
     return RedirectResponse(redirect_url)
 
 @app.post("/webhook/gmail")
-async def receive_gmail_notification(request: Request, background_tasks: BackgroundTasks):
+async def receive_gmail_notification(request: Request):
     try:
         body = await request.json()
         message = body.get("message", {})
@@ -154,11 +205,36 @@ async def receive_gmail_notification(request: Request, background_tasks: Backgro
     # encoded data is email and history_id
     data_encoded = message.get("data")
     if data_encoded:
-        # process email as an async task so the webhook receives the 200 status
-        background_tasks.add_task(execute_gmail_task, data_encoded)
+        try:
+            email, history_id = decode_gmail_notification(data_encoded)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid notification data")
+
+        # the coalescer and the queue use the sync redis client, keep their calls off the event loop
+        if not await asyncio.to_thread(schedule_gmail_ingestion, email, history_id):
+            # pub/sub retries with backoff on non 2xx responses, so a full queue just delays the notification
+            raise HTTPException(status_code=503, detail="Ingestion queue is full")
 
     return {"status": "received"}
 
+
+# returns False if the ingestion queue is full
+def schedule_gmail_ingestion(email: str, history_id) -> bool:
+    if ingestion_queue.is_full():
+        return False
+
+    # only the first notification of a burst queues the mailbox, the rest are folded into it
+    # the ingestion worker does the processing so the webhook receives the 200 status straight away
+    if gmail_coalescer.notify(email, history_id):
+        try:
+            ingestion_queue.enqueue(email, delay=gmail_coalescer.debounce)
+        except IngestionQueueFull:
+            # otherwise pub/sub's retry finds the flag set and nothing is ever queued
+            gmail_coalescer.cancel(email)
+            return False
+
+    return True
+
 websocket_manager = WebsocketManager()
 
 
@@ -166,14 +242,68 @@ websocket_manager = WebsocketManager()
 def root():
     return {"message": "FastAPI is running!"}
 
+# websocket send queue depth and dropped frames for this process
+# async so it runs on the event loop, the loop is what changes the manager's dicts
+@app.get('/metrics/websockets')
+async def websocket_metrics():
+    return websocket_manager.metrics()
+
+# largest page of messages a client can ask for
+CHAT_HISTORY_MAX_PAGE = int(os.getenv("CHAT_HISTORY_MAX_PAGE", 200))
+
+# the history is append only, so the message count and the last message identify it
+def history_etag(chat_id: str, state, *query) -> str:
+    count, last = state
+    last = last or {}
+    key = f"{chat_id}:{count}:{last.get('id')}:{last.get('timestamp')}:{query}"
+
+    return f'"{hashlib.sha1(key.encode()).hexdigest()}"'
+
 #get message history
+#no parameters returns the whole history, limit (and the before cursor) pages it newest first,
+#since returns the messages after a message id or timestamp oldest first
 @app.get('/chat/{user_id}/{chat_id}')
-async def get_messages_data(chat_id: str, user_id: str):
+async def get_messages_data(
+    chat_id: str,
+    user_id: str,
+    limit: Optional[int] = Query(None, ge=1),
+    before: Optional[int] = Query(None, ge=0),
+    since: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
     try:
-        #inititate a new memory instance
+        #inititate a new memory instance, loading the history is blocking
         memory = ConversationManager(chat_id, user_id)
-        # and send messages
-        return memory.messages
+
+        state = await asyncio.to_thread(memory.history_state)
+        if state is None:
+            messages = await asyncio.to_thread(lambda: memory.messages)
+            state = (len(messages), messages[-1] if messages else None)
+
+        # the client already has this version of the history
+        etag = history_etag(chat_id, state, limit, before, since)
+        if if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        if since is not None:
+            messages, has_more = await asyncio.to_thread(memory.get_messages_since, since, min(limit or CHAT_HISTORY_MAX_PAGE, CHAT_HISTORY_MAX_PAGE))
+
+            if messages is None:
+                raise HTTPException(status_code=400, detail="Unknown message id, refetch the history")
+
+            body = {"messages": messages, "has_more": has_more}
+
+        elif limit is not None or before is not None:
+            messages, next_cursor = await asyncio.to_thread(memory.get_message_page, before, min(limit or CHAT_HISTORY_MAX_PAGE, CHAT_HISTORY_MAX_PAGE))
+            body = {"messages": messages, "next_cursor": next_cursor}
+
+        else:
+            # and send messages
+            body = await asyncio.to_thread(lambda: memory.messages)
+
+        return JSONResponse(body, headers={"ETag": etag})
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))   
@@ -195,9 +325,10 @@ async def websocket_endpoint(websocket: WebSocket, chat_id: str):
                     print(f"sending task to {packet.get('receiver')}")
 
                     #dispatch task to orchestrator agent
-                    r.lpush("orchestrator_queue", data)
+                    await dispatch_orchestrator_task(async_r, data)
                 else:
-                    await websocket_manager.send_message(chat_id=chat_id, message=data)
+                    # go through redis so devices connected to other api processes get it too
+                    await websocket_manager.publish(chat_id=chat_id, message=data)
 
 
             except Exception as e:
@@ -217,23 +348,20 @@ async def send_message(userQuery: ChatMessageRequest):
         else:
             current_task_id = userQuery.task_id
         
-        # init client
-        client = OpenAI()
-
         print('task id')
         print(current_task_id)
         print('pending tool id')
         print(userQuery.pending_tool_id)
         
-        client_agent = ClientAgent(name="Client_Agent", client=client, user_id=userQuery.user_id, chat_id=userQuery.chat_id, dispatcher=r, user_message=userQuery.message, pending_tool_id=userQuery.pending_tool_id, task_id=current_task_id)
+        client_agent = ClientAgent(name="Client_Agent", client=openai_client, user_id=userQuery.user_id, chat_id=userQuery.chat_id, dispatcher=async_r, user_message=userQuery.message, pending_tool_id=userQuery.pending_tool_id, task_id=current_task_id)
 
-        response = client_agent.handle_message()
+        response = await client_agent.handle_message()
 
         print("response")
         print(response)
 
 
-        return {"status": response['status'], "task_id": current_task_id, "response_text": response['answer'], "data": userQuery}
+        return {"status": response['status'], "task_id": current_task_id, "response_text": response['answer'], "data": userQuery, "stream_id": response.get('stream_id')}
 
     except Exception as e:
         print(f"Server Error: {e}")
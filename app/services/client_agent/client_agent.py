@@ -1,10 +1,16 @@
+import asyncio
 import json
+import os
+import re
 from typing import Any, Dict, Optional
 from uuid import uuid4
 from pydantic import BaseModel
 from app.services.agent_base import AgentBase
+from app.services.client_agent.intent_classifier import INTENT_CENTROIDS_PATH, intent_classifier
 from app.services.orchestrator.memory import ConversationManager
 from app.services.prompts.prompts import prompt_dict
+from app.utils.task_queue import dispatch_orchestrator_task
+from app.utils.communication_protocol import stream_frame
 
 from dotenv import load_dotenv
 
@@ -12,11 +18,59 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# stream social replies to the chat channel while they're being generated
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "true").lower() == "true"
+
+# classify intents locally on the message embedding, the LLM only gets the messages it isn't sure about
+# on by default only once train_intent_classifier has saved validated centroids, the seed examples alone aren't reliable enough
+INTENT_CLASSIFIER_ENABLED = os.getenv("INTENT_CLASSIFIER_ENABLED", str(os.path.exists(INTENT_CENTROIDS_PATH))).lower() == "true"
+
+# when the LLM has to classify the message, have the same call write the social reply
+CHAT_FUSED_INTENT = os.getenv("CHAT_FUSED_INTENT", "true").lower() == "true"
+
 class CategorizeResponse(BaseModel):
     intent: str
+
+#intent comes first so a task can be dispatched before the reply is generated
+class CategorizeAndReplyResponse(BaseModel):
+    intent: str
+    reply: str
+
+
+#decode the start of a json string value that's still being streamed
+#returns the text so far and whether the closing quote has arrived
+def _partial_json_string(raw: str):
+    escapes = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+    text = []
+    i = 0
+
+    while i < len(raw):
+        char = raw[i]
+
+        if char == '"':
+            return "".join(text), True
+
+        if char == "\\":
+            #wait for the rest of the escape sequence
+            if i + 1 >= len(raw) or (raw[i + 1] == "u" and i + 6 > len(raw)):
+                break
+
+            if raw[i + 1] == "u":
+                text.append(chr(int(raw[i + 2:i + 6], 16)))
+                i += 6
+            else:
+                text.append(escapes.get(raw[i + 1], raw[i + 1]))
+                i += 2
+            continue
+
+        text.append(char)
+        i += 1
+
+    return "".join(text), False
     
 
 class ClientAgent(AgentBase):
+    #client is an AsyncOpenAI client and dispatcher an async redis client, both shared by every request
     def __init__(self, name: str, client: Any, user_id: str, chat_id: str, dispatcher: Any, user_message: str, pending_tool_id: Any, task_id: str):
         super().__init__(name = name, client = client)
 
@@ -25,10 +79,12 @@ class ClientAgent(AgentBase):
         self.task_id = task_id
         self.user_message = user_message
         self.pending_tool_id = pending_tool_id
-        self.message_intent = self._categorize_message_intent()
-        self.memory = ConversationManager(chat_id, user_id)
         self.dispatcher = dispatcher
 
+        #both are set by handle_message, the constructor doesn't do any io
+        self.message_intent = None
+        self.memory = None
+
 
     def receive_message(self, packet):
         return super().receive_message(packet)
@@ -36,30 +92,57 @@ class ClientAgent(AgentBase):
     def get_intent(self):
         return self.message_intent
     
-    def handle_message(self):
+    #supabase calls are blocking so they run in the thread pool, the llm and redis calls are awaited
+    async def handle_message(self):
+        #classify the message while the chat history loads
+        self.message_intent, self.memory = await asyncio.gather(
+            self._categorize_message_intent(),
+            asyncio.to_thread(ConversationManager, self.chat_id, self.user_id),
+        )
+
+        #the local classifier wasn't sure, one LLM call picks the intent and writes the social reply
+        if self.message_intent is None and CHAT_FUSED_INTENT:
+            return await self._handle_fused_message()
+
         if self.message_intent == "SOCIAL":
             #handle social message
-            return self._handle_social_message()
+            return await self._handle_social_message()
 
         elif self.message_intent == "TASK" or self.message_intent == "TOOL_USE":
             #handle task usage
-            return self._handle_task_message()
+            return await self._handle_task_message()
 
         elif self.message_intent == "EMERGENCY":
             #handle emergency
             return
 
 
-    def _categorize_message_intent(self):
+    async def _categorize_message_intent(self):
         try:
             if self.pending_tool_id != None:
                 return "TOOL_USE"
 
+            if INTENT_CLASSIFIER_ENABLED:
+                #embedding the message is cpu work so it runs in the thread pool
+                try:
+                    intent = await asyncio.to_thread(intent_classifier.classify, self.user_message)
+                except Exception as e:
+                    print(f"local intent classifier failed, using the LLM: {e}")
+                    intent = None
+
+                if intent is not None:
+                    print(f"user intent (local): {intent}")
+                    return intent
+
+            #left to the fused call in handle_message
+            if CHAT_FUSED_INTENT:
+                return None
+
             #make an LLM call to figure out what to do with the user message
-            response = self.client.responses.parse(
+            response = await self.client.responses.parse(
                 model="gpt-5-nano",
                 input=self.user_message,
-                instructions="Categorize the user message into ONE of the following intents: SOCIAL, EMERGENCY, TASK (TASK includes asking for horoscope and calculating a route)",
+                instructions=prompt_dict["intent_categorization_prompt"],
                 text_format= CategorizeResponse,
             )
 
@@ -73,32 +156,129 @@ class ClientAgent(AgentBase):
             print(f"Server Error In categorize message: {e}")
     
     #reply to non urgent message
-    def _handle_social_message(self):
+    async def _handle_social_message(self):
 
         #add user message to DB
-        self.memory.add_message(self.user_message, "user")
+        await asyncio.to_thread(self.memory.add_message, self.user_message, "user")
+
+        #set when the reply was streamed, so the app can match the streamed preview with this answer
+        stream_id = None
+
+        if CHAT_STREAMING:
+            final_response, stream_id = await self._stream_social_reply()
+        else:
+            #GPT call
+            response = await self.client.responses.parse(
+                model="gpt-5-nano",
+                instructions=prompt_dict["front_facing_agent_social_prompt"],
+                input=self.user_message
+            )
+
+            final_response = response.output[1].content[0].text
+
+        #add response to DB
+        await asyncio.to_thread(self.memory.add_message, final_response, "assistant")
 
-        #GPT call
-        response = self.client.responses.parse(
+        return {"answer": final_response, "status": "Completed", "stream_id": stream_id}
+
+    #classify and reply in a single call, streamed so a task is dispatched as soon as the intent is known
+    #and a social reply reaches the chat channel as it's generated
+    async def _handle_fused_message(self):
+        stream_id = str(uuid4())
+        output = ""
+        streamed = ""
+        save_user_message = None
+
+        async with self.client.responses.stream(
+            model="gpt-5-nano",
+            instructions=prompt_dict["intent_and_social_reply_prompt"],
+            input=self.user_message,
+            text_format=CategorizeAndReplyResponse,
+        ) as stream:
+            async for event in stream:
+                if event.type != "response.output_text.delta":
+                    continue
+
+                output += event.delta
+
+                if self.message_intent is None:
+                    match = re.search(r'"intent"\s*:\s*"(\w+)"', output)
+                    if not match:
+                        continue
+
+                    self.message_intent = match.group(1)
+                    print(f"user intent (fused): {self.message_intent}")
+
+                    #no reply needed, leaving the block closes the stream
+                    if self.message_intent != "SOCIAL":
+                        break
+
+                    save_user_message = asyncio.create_task(asyncio.to_thread(self.memory.add_message, self.user_message, "user"))
+
+                if not CHAT_STREAMING:
+                    continue
+
+                #publish whatever part of the reply has arrived since the last delta
+                reply_start = re.search(r'"reply"\s*:\s*"', output)
+                if reply_start:
+                    reply, _ = _partial_json_string(output[reply_start.end():])
+
+                    if len(reply) > len(streamed):
+                        await self._publish_frame(stream_id, "delta", {"delta": reply[len(streamed):]})
+                        streamed = reply
+
+            if self.message_intent == "SOCIAL":
+                final_response = (await stream.get_final_response()).output_parsed.reply
+
+        if self.message_intent == "TASK":
+            return await self._handle_task_message()
+
+        if self.message_intent != "SOCIAL":
+            #emergency, same as the two call path
+            return
+
+        if CHAT_STREAMING:
+            await self._publish_frame(stream_id, "end", {"message": final_response})
+
+        #the user message has to be saved before the reply
+        await save_user_message
+        await asyncio.to_thread(self.memory.add_message, final_response, "assistant")
+
+        return {"answer": final_response, "status": "Completed", "stream_id": stream_id if CHAT_STREAMING else None}
+
+    #same GPT call, the reply goes out to the chat channel as it's generated
+    #returns the reply and the stream_id it was published under
+    async def _stream_social_reply(self):
+        stream_id = str(uuid4())
+
+        async with self.client.responses.stream(
             model="gpt-5-nano",
             instructions=prompt_dict["front_facing_agent_social_prompt"],
             input=self.user_message
-        )
+        ) as stream:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    await self._publish_frame(stream_id, "delta", {"delta": event.delta})
 
-        final_response = response.output[1].content[0].text
+            final_response = (await stream.get_final_response()).output_text
 
-        #add response to DB
-        self.memory.add_message(final_response, "assistant")
+        await self._publish_frame(stream_id, "end", {"message": final_response})
+
+        return final_response, stream_id
+
+    async def _publish_frame(self, stream_id, event, content):
+        try:
+            await self.dispatcher.publish(self.chat_id, stream_frame(self.chat_id, self.name, stream_id, event, content, self.task_id))
+        except Exception as e:
+            print(f"Error publishing stream frame for {self.chat_id}: {e}")
 
-        return {"answer": final_response, "status": "Completed"}
-    
     #send task to redis queue for other agent
-    def _handle_task_message(self):
+    async def _handle_task_message(self):
         try:
 
             print("TASK FUNCTION ENTERED")
             #add user message to DB
-            self.memory.add_message(self.user_message, "user")
+            await asyncio.to_thread(self.memory.add_message, self.user_message, "user")
 
             #create packet
             packet = {
@@ -120,17 +300,17 @@ class ClientAgent(AgentBase):
 
 
             #dispatch
-            self.dispatcher.lpush("orchestrator_queue", packet_json)
+            await dispatch_orchestrator_task(self.dispatcher, packet_json)
             print("past sending")
 
             #if there's no tool usage
             if self.pending_tool_id != None:
                 message = 'Thank you for the clarifying information, let me get that ready and come back with the answer in just a minute.'
                 #add quick response to db
-                self.memory.add_message(message, 'assistant')
+                await asyncio.to_thread(self.memory.add_message, message, 'assistant')
                 return {"answer": message, "status": "Completed"}
             
-            self.memory.add_message("Of course, I'll let you know when I'm ready to reply", 'assistant')
+            await asyncio.to_thread(self.memory.add_message, "Of course, I'll let you know when I'm ready to reply", 'assistant')
 
             return {"answer": "Of course, I'll let you know when I'm ready to reply", "status": "Completed"}
 
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import numpy as np
+from app.utils.embedding_model import get_embedding_model
+
+INTENTS = ["SOCIAL", "TASK", "EMERGENCY"]
+
+# where the retraining tool writes the centroids, without the file we fit on the seed examples below
+INTENT_CENTROIDS_PATH = os.getenv(
+    "INTENT_CENTROIDS_PATH",
+    os.path.join(os.path.dirname(__file__), "intent_centroids.json")
+)
+
+# below this margin between the best and second best intent we ask the LLM instead
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", 0.04))
+
+# a few examples per intent so the classifier works before it has been trained on real chats
+SEED_EXAMPLES = [
+    ("hi, how are you today?", "SOCIAL"),
+    ("good morning!", "SOCIAL"),
+    ("thank you so much, that was really helpful", "SOCIAL"),
+    ("I'm feeling a bit lonely tonight", "SOCIAL"),
+    ("tell me something nice", "SOCIAL"),
+    ("I had a lovely walk in the park with my daughter", "SOCIAL"),
+    ("do you remember what we talked about yesterday?", "SOCIAL"),
+    ("what's my horoscope for today?", "TASK"),
+    ("how do I get to the hospital from here?", "TASK"),
+    ("when is my next doctor's appointment?", "TASK"),
+    ("can you check my emails?", "TASK"),
+    ("add a dentist appointment to my calendar on friday", "TASK"),
+    ("give me directions home", "TASK"),
+    ("what's on my calendar tomorrow?", "TASK"),
+    ("I've fallen and I can't get up", "EMERGENCY"),
+    ("help, I have chest pain", "EMERGENCY"),
+    ("I'm lost and I don't know where I am", "EMERGENCY"),
+    ("call an ambulance", "EMERGENCY"),
+    ("someone is trying to break into my house", "EMERGENCY"),
+    ("I can't breathe properly", "EMERGENCY"),
+]
+
+
+# nearest centroid over the gte-small embeddings, each intent is the mean of its normalised examples
+# answers in a few milliseconds on cpu so most messages never pay for an LLM call
+class IntentClassifier:
+    def __init__(self, centroids_path: str = INTENT_CENTROIDS_PATH, threshold: float = INTENT_CONFIDENCE_THRESHOLD):
+        self.centroids_path = centroids_path
+        self.threshold = threshold
+
+        self.labels: list[str] = []
+        self.centroids = None
+        self.lock = threading.Lock()
+
+    def _embed(self, texts: list[str]):
+        return get_embedding_model().encode(texts, normalize_embeddings=True)
+
+    # load the trained centroids, or fit on the seed examples if there aren't any yet
+    def _ensure_loaded(self):
+        if self.centroids is not None:
+            return
+
+        with self.lock:
+            if self.centroids is not None:
+                return
+
+            if os.path.exists(self.centroids_path):
+                self.load(self.centroids_path)
+            else:
+                self.fit(SEED_EXAMPLES)
+
+    def fit(self, examples: list[tuple[str, str]]):
+        texts = [text for text, _ in examples]
+        labels = [label for _, label in examples]
+        embeddings = self._embed(texts)
+
+        found = [intent for intent in INTENTS if intent in labels]
+        centroids = []
+
+        for intent in found:
+            centroid = embeddings[[i for i, label in enumerate(labels) if label == intent]].mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+
+        self.labels = found
+        self.centroids = np.array(centroids)
+
+    def save(self, path: str | None = None):
+        with open(path or self.centroids_path, "w") as f:
+            json.dump({"labels": self.labels, "centroids": self.centroids.tolist()}, f)
+
+    def load(self, path: str | None = None):
+        with open(path or self.centroids_path) as f:
+            data = json.load(f)
+
+        self.labels = data["labels"]
+        self.centroids = np.array(data["centroids"])
+
+    # returns (intent, confidence) where confidence is the margin between the two closest intents
+    def predict(self, text: str) -> tuple[str, float]:
+        return self.predict_batch([text])[0]
+
+    def predict_batch(self, texts: list[str]) -> list[tuple[str, float]]:
+        self._ensure_loaded()
+
+        scores = self._embed(texts) @ self.centroids.T
+        results = []
+
+        for row in scores:
+            ranked = np.argsort(row)[::-1]
+            margin = row[ranked[0]] - row[ranked[1]] if len(ranked) > 1 else 1.0
+            results.append((self.labels[ranked[0]], float(margin)))
+
+        return results
+
+    # None means the classifier isn't sure and the caller should ask the LLM
+    def classify(self, text: str) -> str | None:
+        intent, confidence = self.predict(text)
+
+        return intent if confidence >= self.threshold else None
+
+    # accuracy on labelled examples, overall and for the messages we'd answer without the LLM
+    def evaluate(self, examples: list[tuple[str, str]]) -> dict:
+        predictions = self.predict_batch([text for text, _ in examples])
+
+        confident = [(intent, label) for (intent, confidence), (_, label) in zip(predictions, examples) if confidence >= self.threshold]
+        per_intent = {}
+
+        for (intent, _), (_, label) in zip(predictions, examples):
+            correct, total = per_intent.get(label, (0, 0))
+            per_intent[label] = (correct + (intent == label), total + 1)
+
+        return {
+            "examples": len(examples),
+            "accuracy": sum(intent == label for (intent, _), (_, label) in zip(predictions, examples)) / max(len(examples), 1),
+            "per_intent_accuracy": {label: correct / total for label, (correct, total) in per_intent.items()},
+            "threshold": self.threshold,
+            "llm_fallback_rate": 1 - len(confident) / max(len(examples), 1),
+            "confident_accuracy": sum(intent == label for intent, label in confident) / max(len(confident), 1),
+        }
+
+
+intent_classifier = IntentClassifier()
@@ -0,0 +1,169 @@
+import argparse
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from app.services.client_agent.client_agent import CategorizeResponse
+from app.services.client_agent.intent_classifier import INTENTS, SEED_EXAMPLES, IntentClassifier
+from app.services.orchestrator.memory import CHAT_MESSAGES_PAGE_SIZE, CHAT_MESSAGES_TABLE, CHAT_STORAGE
+from app.services.prompts.prompts import prompt_dict
+from app.utils.supabase_pool import get_supabase_client
+
+load_dotenv()
+
+# retrain and evaluate the local intent classifier from the logged chats
+# the user messages are labelled by the LLM classifier (the one the local classifier replaces),
+# or read from a jsonl file of {"text": ..., "intent": ...} lines with hand checked labels
+#
+#   python -m app.services.client_agent.train_intent_classifier --limit 2000 --labels-out labels.jsonl
+#   python -m app.services.client_agent.train_intent_classifier --labels labels.jsonl --threshold 0.05
+
+
+# user messages from the chat_messages rows
+def _load_message_rows(client, limit: int) -> list[str]:
+    messages = []
+    page = 0
+
+    while len(messages) < limit:
+        response = (
+            client.table(CHAT_MESSAGES_TABLE).select("content")
+            .eq("role", "user")
+            .order("chat_id").order("seq")
+            .range(page * CHAT_MESSAGES_PAGE_SIZE, (page + 1) * CHAT_MESSAGES_PAGE_SIZE - 1)
+            .execute()
+        )
+
+        if not response.data:
+            break
+
+        messages.extend(row["content"] for row in response.data if row.get("content"))
+        page += 1
+
+    return messages
+
+
+# user messages from wherever the chats are stored, the chats.messages arrays stop being updated once CHAT_STORAGE=rows
+def load_logged_messages(limit: int) -> list[str]:
+    client = get_supabase_client()
+
+    if CHAT_STORAGE == "rows":
+        # the same greeting shows up in a lot of chats
+        return list(dict.fromkeys(_load_message_rows(client, limit)))[:limit]
+
+    messages = []
+    page = 0
+
+    while len(messages) < limit:
+        response = (
+            client.table("chats").select("messages")
+            .order("chat_id")
+            .range(page * 100, page * 100 + 99)
+            .execute()
+        )
+
+        if not response.data:
+            break
+
+        for row in response.data:
+            chat_messages = row["messages"] or []
+            # a chat with a single message is stored as an object
+            if isinstance(chat_messages, dict):
+                chat_messages = [chat_messages]
+
+            messages.extend(message["content"] for message in chat_messages if message.get("role") == "user" and message.get("content"))
+
+        page += 1
+
+    # the same greeting shows up in a lot of chats
+    return list(dict.fromkeys(messages))[:limit]
+
+
+def label_with_llm(messages: list[str], workers: int) -> list[tuple[str, str]]:
+    client = OpenAI()
+
+    def label(text):
+        try:
+            response = client.responses.parse(
+                model="gpt-5-nano",
+                input=text,
+                instructions=prompt_dict["intent_categorization_prompt"],
+                text_format=CategorizeResponse,
+            )
+            return text, response.output[1].content[0].parsed.intent
+        except Exception as e:
+            print(f"couldn't label {text!r}: {e}")
+            return text, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        labelled = list(executor.map(label, messages))
+
+    return [(text, intent) for text, intent in labelled if intent in INTENTS]
+
+
+def read_labels(path: str) -> list[tuple[str, str]]:
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+
+    return [(row["text"], row["intent"]) for row in rows if row.get("intent") in INTENTS]
+
+
+def write_labels(path: str, examples: list[tuple[str, str]]):
+    with open(path, "w") as f:
+        for text, intent in examples:
+            f.write(json.dumps({"text": text, "intent": intent}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="retrain and evaluate the local intent classifier")
+    parser.add_argument("--labels", help="jsonl file with labelled messages, skips the chats table and the LLM")
+    parser.add_argument("--labels-out", help="write the LLM labelled messages here so they can be checked and reused")
+    parser.add_argument("--limit", type=int, default=1000, help="how many logged user messages to label")
+    parser.add_argument("--workers", type=int, default=8, help="parallel LLM labelling calls")
+    parser.add_argument("--test-split", type=float, default=0.2, help="share of the examples held out for evaluation")
+    parser.add_argument("--threshold", type=float, help="confidence threshold to evaluate with")
+    parser.add_argument("--output", help="where to write the centroids, defaults to INTENT_CENTROIDS_PATH")
+    parser.add_argument("--dry-run", action="store_true", help="evaluate without writing the centroids")
+    args = parser.parse_args()
+
+    if args.labels:
+        examples = read_labels(args.labels)
+    else:
+        messages = load_logged_messages(args.limit)
+        print(f"labelling {len(messages)} logged messages")
+        examples = label_with_llm(messages, args.workers)
+
+        if args.labels_out:
+            write_labels(args.labels_out, examples)
+
+    random.Random(0).shuffle(examples)
+    split = int(len(examples) * (1 - args.test_split))
+    train, test = examples[:split], examples[split:]
+
+    classifier = IntentClassifier()
+    if args.threshold is not None:
+        classifier.threshold = args.threshold
+
+    # the seed examples keep every intent represented, emergencies are rare in the logs
+    classifier.fit(train + SEED_EXAMPLES)
+
+    counts = {intent: sum(label == intent for _, label in examples) for intent in INTENTS}
+    print(f"{len(train)} training / {len(test)} test examples, {counts}")
+
+    if test:
+        print(json.dumps(classifier.evaluate(test), indent=2))
+
+        # how the threshold trades LLM calls for accuracy
+        for threshold in (0.0, 0.02, 0.04, 0.06, 0.08, 0.1):
+            classifier.threshold = threshold
+            report = classifier.evaluate(test)
+            print(f"threshold {threshold:.2f}: llm fallback {report['llm_fallback_rate']:.1%}, accuracy without llm {report['confident_accuracy']:.1%}")
+
+    if not args.dry_run:
+        classifier.save(args.output)
+        print(f"saved centroids to {args.output or classifier.centroids_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,31 @@ from typing import Literal
 import uuid
 from pydantic import BaseModel, Field
 import redis
-from supabase import Client, create_client
+from supabase import Client
 from app.services.google_services.calendar_service.calendar_client import CalendarClient
 from app.services.google_services.gmail_service.gmail_client import GmailClient
 from app.services.data_interpreter.email_processor import EmailChunker, EmailEmbedder, EmailUpserter
 from app.services.google_services.google_service_builder import GoogleServiceBuilder
 from app.services.user_manager import CredentialManager
+from app.utils.supabase_pool import get_supabase_client
+from app.utils.task_queue import dispatch_orchestrator_task
 
 
 redis_host = os.getenv("REDIS_HOST", "localhost")
 
+# how many inbox messages we look at when we can't sync incrementally
+GMAIL_RESYNC_LIMIT = int(os.getenv("GMAIL_RESYNC_LIMIT", 50))
+
 r = redis.Redis(host=redis_host, port=6379, db=0)
 
+# an email that fails this many runs stops holding the history id back, it's parked for manual handling
+GMAIL_EMAIL_RETRY_LIMIT = int(os.getenv("GMAIL_EMAIL_RETRY_LIMIT", 3))
+
+# email id -> failed runs, and the set of parked email ids, per user
+GMAIL_FAILED_EMAILS_KEY = "gmail_failed_emails:{user_id}"
+GMAIL_PARKED_EMAILS_KEY = "gmail_parked_emails:{user_id}"
+GMAIL_FAILED_EMAILS_TTL = 30 * 24 * 60 * 60
+
 class AppointmentFilter(BaseModel):
     id: str | None
     summary: str | None= Field(
@@ -72,9 +85,27 @@ class EmailIngestionPipeline:
         self.email_embedder = EmailEmbedder()
 
     
-    def run(self):
+    # get the ids of the emails we haven't processed yet and the history id to save once we're done
+    def _get_new_email_ids(self, history_id=None):
+        last_history_id = self.credential_manager.get_gmail_history_id(self.user_id)
+
+        # incremental sync, exactly the messages added since the last run
+        if last_history_id:
+            history = self.gmail_service.get_history_email_ids(last_history_id)
+
+            if history is not None:
+                new_email_ids, latest_history_id = history
+
+                # a run that had failures didn't move the history id, the emails it did store (or parked) aren't processed again
+                stored_email_ids = self.email_upserter.filter_email_ids(new_email_ids) | self._parked_email_ids()
+                new_email_ids = [id for id in new_email_ids if id not in stored_email_ids]
+
+                return new_email_ids, max_history_id(history_id, latest_history_id)
+
+        print("running full resync")
+
         #get email_ids
-        email_ids = self.gmail_service.get_email_ids()
+        email_ids = self.gmail_service.get_email_ids(max_results=GMAIL_RESYNC_LIMIT)
 
         #filter the duplicated ids
         duplicate_email_ids = self.email_upserter.filter_email_ids(email_ids)
@@ -89,28 +120,95 @@ class EmailIngestionPipeline:
             #get emails that are not inclided in our duplicated ids
             new_email_ids = [id for id in email_ids if id not in duplicate_email_ids]
 
+        return new_email_ids, history_id
+
+    def _save_history_id(self, history_id):
+        if history_id:
+            self.credential_manager.set_gmail_history_id(self.user_id, history_id)
+
+    def _parked_email_ids(self) -> set:
+        try:
+            return {email_id.decode("utf-8") for email_id in r.smembers(GMAIL_PARKED_EMAILS_KEY.format(user_id=self.user_id))}
+        except Exception as e:
+            print(f"couldn't read the parked emails of {self.user_id}: {e}")
+            return set()
+
+    # count the failures, returns the failed ids that are still retried, the ones over the limit get parked
+    def _record_failures(self, email_ids: list[str], failed_ids: list[str]) -> list[str]:
+        failed_key = GMAIL_FAILED_EMAILS_KEY.format(user_id=self.user_id)
+        parked_key = GMAIL_PARKED_EMAILS_KEY.format(user_id=self.user_id)
+
+        try:
+            pipe = r.pipeline()
+            for email_id in failed_ids:
+                pipe.hincrby(failed_key, email_id, 1)
+            succeeded = [email_id for email_id in email_ids if email_id not in failed_ids]
+            if succeeded:
+                pipe.hdel(failed_key, *succeeded)
+            pipe.expire(failed_key, GMAIL_FAILED_EMAILS_TTL)
+            counts = pipe.execute()[:len(failed_ids)]
+        except Exception as e:
+            # without the counts every failure holds the history id back
+            print(f"couldn't count the failed emails of {self.user_id}: {e}")
+            return failed_ids
+
+        retried = [email_id for email_id, count in zip(failed_ids, counts) if count < GMAIL_EMAIL_RETRY_LIMIT]
+        parked = [email_id for email_id in failed_ids if email_id not in retried]
+
+        if parked:
+            print(f"parking {len(parked)} emails after {GMAIL_EMAIL_RETRY_LIMIT} failed runs: {parked}")
+            pipe = r.pipeline()
+            pipe.sadd(parked_key, *parked)
+            pipe.hdel(failed_key, *parked)
+            pipe.execute()
+
+        return retried
+
+    # moving the history id past a failed email would skip it for good, the next run picks it up again
+    def _finish(self, email_ids: list[str], failed_ids: list[str], history_id):
+        retried = self._record_failures(email_ids, failed_ids)
+
+        if retried:
+            print(f"keeping the gmail history id, {len(retried)} emails are retried on the next run: {retried}")
+        else:
+            self._save_history_id(history_id)
+
+    # history_id is the one sent in the pub/sub notification
+    def run(self, history_id=None):
+        new_email_ids, new_history_id = self._get_new_email_ids(history_id)
+
         if not new_email_ids:
             print("No new emails to upload")
+            self._save_history_id(new_history_id)
             return
         
-        new_emails = self.gmail_service.get_emails(new_email_ids)
+        # a fetch that fails as a whole raises, so the history id isn't saved
+        new_emails, failed_fetch_ids = self.gmail_service.get_emails(new_email_ids)
+
+        if failed_fetch_ids:
+            print(f"couldn't fetch {len(failed_fetch_ids)} emails: {failed_fetch_ids}")
 
         # filter emails to see if they're appointments
-        appointment_emails = self.filter_appointments(new_emails)
+        appointment_emails = self.filter_appointments(new_emails) if new_emails else None
 
         if not appointment_emails:
             print("No new appointments to upload")
+            self._finish(new_email_ids, failed_fetch_ids, new_history_id)
             return
 
         # chunk appointment emails
         chunked_emails = self.email_chunker.chunk_emails(appointment_emails)
 
         #process each email
+        failed_email_ids = list(failed_fetch_ids)
         for email in chunked_emails:
             try:
                 self.process_email(email)
             except Exception as e:
                 print(f"Failed to process email {email.get('id')}: {e}")
+                failed_email_ids.append(email.get("id"))
+
+        self._finish(new_email_ids, failed_email_ids, new_history_id)
         
         return appointment_emails
 
@@ -194,10 +292,7 @@ class CalendarEventManager:
 
         self.google_calendar_client = CalendarClient(self.user_id, self.credential_manager, service=calendar_service, scopes=scopes)
         
-        self.url = os.environ.get("SUPABASE_URL")
-        self.key = os.environ.get("SUPABASE_API_KEY")
-        
-        self.client: Client = create_client(self.url, self.key)
+        self.client: Client = get_supabase_client()
 
         #get redis info for orchestrator queue
         self.redis_host = os.getenv("REDIS_HOST", "localhost")
@@ -283,7 +378,7 @@ class CalendarEventManager:
             data = json.dumps(packet)
 
                 #dispatch task to orchestrator agent
-            r.lpush("orchestrator_queue", data)
+            dispatch_orchestrator_task(r, data)
             return "CONFLICTING EVENTS FOUND"
 
     def _reschedule_appointment(self, appointment_summary, appointment_start_time, appointment_end_time, appointment_thread_id):
@@ -326,11 +421,14 @@ def generate_end_time(appointment_start_time, time_added):
 
     return end_str
 
+# history ids are numeric strings, keep the highest one we've seen
+def max_history_id(*history_ids):
+    history_ids = [int(history_id) for history_id in history_ids if history_id]
+
+    return str(max(history_ids)) if history_ids else None
+
 def get_chat_id(user_id):
-    supabase = create_client(
-        os.environ.get("SUPABASE_URL"),
-        os.environ.get("SUPABASE_API_KEY")
-    )
+    supabase = get_supabase_client()
 
     # get user_id from supabase 
     try:
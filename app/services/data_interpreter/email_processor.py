@@ -1,7 +1,7 @@
-import os
 import uuid
-from supabase import Client, create_client
-from sentence_transformers import SentenceTransformer
+from supabase import Client
+from app.utils.embedding_model import get_embedding_model
+from app.utils.supabase_pool import get_supabase_client
 
 # class email(BaseModel):
 #     id: str
@@ -90,7 +90,8 @@ class EmailChunker:
         
 class EmailEmbedder:
     def __init__(self):
-        self.model = SentenceTransformer("Supabase/gte-small")
+        # shared by every pipeline the ingestion worker runs
+        self.model = get_embedding_model()
 
     def generate_embeddings(self, chunks: list[str]):
         return self.model.encode(
@@ -100,10 +101,7 @@ class EmailEmbedder:
 
 class EmailUpserter:
     def __init__(self, user_id):
-        self.url = os.environ.get("SUPABASE_URL")
-        self.key = os.environ.get("SUPABASE_API_KEY")
-        
-        self.client: Client = create_client(self.url, self.key)
+        self.client: Client = get_supabase_client()
 
         self.user_id = user_id
 
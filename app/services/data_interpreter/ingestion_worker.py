@@ -0,0 +1,98 @@
+import os
+import signal
+import threading
+from dotenv import load_dotenv
+import redis
+
+from app.utils.gmail_coalescer import GmailNotificationCoalescer
+from app.utils.helper_funcs import run_gmail_ingestion
+from app.utils.ingestion_queue import IngestionQueue
+
+load_dotenv()
+
+redis_host = os.getenv("REDIS_HOST", "localhost")
+
+r = redis.Redis(host=redis_host, port=6379, db=0)
+
+# how many mailboxes we ingest at the same time and how often idle workers look for new ones
+INGESTION_CONCURRENCY = int(os.getenv("INGESTION_CONCURRENCY", 4))
+INGESTION_POLL_INTERVAL = float(os.getenv("INGESTION_POLL_INTERVAL", 0.5))
+
+
+# refresh the mailbox's run flag until the ingestion is done
+def keep_scheduled(email: str, coalescer: GmailNotificationCoalescer, done: threading.Event):
+    while not done.wait(coalescer.flag_ttl / 3):
+        try:
+            coalescer.refresh(email)
+        except Exception as e:
+            print(f"couldn't refresh the run flag of {email}: {e}")
+
+
+def process_mailbox(email: str, queue: IngestionQueue, coalescer: GmailNotificationCoalescer):
+    # notifications are still coming in, come back once the burst is over
+    wait = coalescer.seconds_until_ready(email)
+    if wait > 0:
+        queue.requeue(email, delay=wait)
+        return
+
+    history_id = coalescer.take(email)
+    print(f"ingesting {email} up to history id {history_id}")
+
+    done = threading.Event()
+    keeper = threading.Thread(target=keep_scheduled, args=(email, coalescer, done), name=f"keep-{email}", daemon=True)
+    keeper.start()
+
+    try:
+        run_gmail_ingestion(email, history_id)
+    except Exception as e:
+        print(f"gmail ingestion failed for {email}: {e}")
+    finally:
+        done.set()
+        keeper.join()
+
+    # notifications that came in while we were running get another pass
+    if not coalescer.release(email):
+        queue.requeue(email, delay=coalescer.debounce)
+
+
+def worker_loop(stop_event: threading.Event, queue: IngestionQueue, coalescer: GmailNotificationCoalescer):
+    while not stop_event.is_set():
+        email = queue.claim()
+
+        if email is None:
+            stop_event.wait(INGESTION_POLL_INTERVAL)
+            continue
+
+        process_mailbox(email, queue, coalescer)
+
+
+def main():
+    queue = IngestionQueue(r)
+    coalescer = GmailNotificationCoalescer(r)
+
+    stop_event = threading.Event()
+
+    # let the running ingestions finish before exiting
+    def shutdown(signum, frame):
+        print("ingestion worker shutting down...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"ingestion worker running with {INGESTION_CONCURRENCY} workers")
+
+    workers = [
+        threading.Thread(target=worker_loop, args=(stop_event, queue, coalescer), name=f"ingestion-{i}")
+        for i in range(INGESTION_CONCURRENCY)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
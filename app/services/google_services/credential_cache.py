@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import os
+import socket
+import threading
+import time
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from app.services.google_services.service_cache import service_cache
+
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+
+# every api worker and replica runs a scheduler, whoever holds this key does the interval's refresh cycle
+TOKEN_REFRESH_LOCK_KEY = "token_refresh_lock"
+
+
+# google-auth compares expiry against a naive utc datetime
+def _naive_utc(expiry: datetime):
+    if expiry.tzinfo is not None:
+        return expiry.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiry
+
+
+#build a credentials object from a user_credentials row
+def build_credentials(token: dict, scopes: list[str] | None = None) -> Credentials:
+    credentials = Credentials(
+        token = token['google_access_token'],
+        refresh_token = token['google_refresh_token'],
+        token_uri = TOKEN_URI,
+        client_id = os.environ.get("OAUTH_CLIENT2_ID"),
+        client_secret= os.environ.get("OAUTH_CLIENT2_SECRET"),
+        scopes= scopes,
+    )
+
+    credentials.expiry = _naive_utc(datetime.fromisoformat(token['expiry']))
+
+    return credentials
+
+
+class CredentialCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user_id -> Credentials, an entry lives until its token expires
+        self.credentials = {}
+
+    def get(self, user_id: str):
+        with self.lock:
+            credentials = self.credentials.get(user_id)
+
+            if credentials is None:
+                return None
+
+            # the ttl is the token's own expiry, after that the row in the db is the source of truth
+            if credentials.expired:
+                del self.credentials[user_id]
+                return None
+
+            return credentials
+
+    def set(self, user_id: str, credentials: Credentials):
+        with self.lock:
+            self.credentials[user_id] = credentials
+
+    def evict(self, user_id: str):
+        with self.lock:
+            self.credentials.pop(user_id, None)
+
+
+credential_cache = CredentialCache()
+
+
+class TokenRefreshScheduler:
+    def __init__(self, credential_manager, cache: CredentialCache = credential_cache, redis_client=None):
+        self.credential_manager = credential_manager
+        self.cache = cache
+        # without redis every scheduler refreshes on its own
+        self.r = redis_client
+
+        # how often we look for tokens and how long before expiry we refresh them
+        self.interval = int(os.getenv("TOKEN_REFRESH_INTERVAL", 60))
+        self.margin = int(os.getenv("TOKEN_REFRESH_MARGIN", 600))
+        # tokens that expired longer ago than this belong to inactive or revoked users, they're refreshed on use instead
+        self.grace = int(os.getenv("TOKEN_REFRESH_GRACE", 3600))
+        self.batch_size = int(os.getenv("TOKEN_REFRESH_BATCH_SIZE", 50))
+        self.max_workers = int(os.getenv("TOKEN_REFRESH_WORKERS", 8))
+
+        # users whose refresh failed (revoked access etc), skipped until the timestamp
+        self.backoff = {}
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, name="token-refresh", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=self.interval)
+
+    # the lock is left to expire after the interval, so there's one cycle per interval across all the processes
+    # and a process that dies mid cycle only holds it for one interval
+    def _acquire_cycle(self) -> bool:
+        if self.r is None:
+            return True
+
+        try:
+            return bool(self.r.set(TOKEN_REFRESH_LOCK_KEY, socket.gethostname(), nx=True, ex=self.interval))
+        except Exception as e:
+            # refreshing twice is better than not refreshing
+            print(f"token refresh lock unavailable: {e}")
+            return True
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            try:
+                if self._acquire_cycle():
+                    self.refresh_expiring_tokens()
+            except Exception as e:
+                print(f"token refresh error: {e}")
+
+            self.stop_event.wait(self.interval)
+
+    def _refresh(self, token: dict):
+        user_id = token['user_id']
+
+        # refresh a copy so services using the cached credentials never see a half refreshed object
+        cached = self.cache.get(user_id)
+        credentials = build_credentials(token, scopes=cached.scopes if cached else None)
+
+        try:
+            credentials.refresh(Request())
+            return user_id, credentials
+        except Exception as e:
+            print(f"failed to refresh token for {user_id}: {e}")
+            self.backoff[user_id] = time.time() + self.margin
+            return user_id, None
+
+    # refresh every token that expires within the margin, in batches, and save them with one upsert per batch
+    def refresh_expiring_tokens(self):
+        utc_now = datetime.now(timezone.utc)
+        expires_before = utc_now + timedelta(seconds=self.margin)
+        expires_after = utc_now - timedelta(seconds=self.grace)
+        # over fetch by the users in backoff so they can't take up the whole batch
+        tokens = self.credential_manager.get_expiring_google_tokens(expires_before, limit=self.batch_size + len(self.backoff), expires_after=expires_after)
+
+        now = time.time()
+        tokens = [token for token in tokens if token.get('google_refresh_token') and self.backoff.get(token['user_id'], 0) <= now][:self.batch_size]
+
+        if not tokens:
+            return
+
+        print(f"refreshing {len(tokens)} google tokens")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._refresh, tokens))
+
+        refreshed = []
+        for user_id, credentials in results:
+            if credentials is None:
+                continue
+
+            self.backoff.pop(user_id, None)
+            self.cache.set(user_id, credentials)
+            service_cache.evict_user(user_id)
+
+            refreshed.append({
+                "user_id": user_id,
+                "access_token": credentials.token,
+                "refresh_token": credentials.refresh_token,
+                "expiry": credentials.expiry,
+            })
+
+        self.credential_manager.add_google_tokens_batch(refreshed)
@@ -1,6 +1,18 @@
 from email.message import EmailMessage
 from app.services.google_services.google_base_client import BaseGoogleClient
 import base64
+from googleapiclient.errors import HttpError
+
+# gmail accepts up to 100 calls per batch request but recommends staying under 50 to avoid rate limiting
+GMAIL_MAX_BATCH_SIZE = 100
+GMAIL_BATCH_SIZE = 50
+
+# partial responses, everything _format_email reads and nothing else
+EMAIL_FIELDS = {
+    "full": "id,threadId,payload(headers(name,value),parts(mimeType,body/data))",
+    # headers only, the body comes back as None
+    "metadata": "id,threadId,payload/headers(name,value)",
+}
 
 class GmailClient(BaseGoogleClient):
     def __init__(self, user_id: str, credential_manager, service, scopes):
@@ -16,7 +28,8 @@ class GmailClient(BaseGoogleClient):
         }
         
         try: 
-            service.users().watch(userId="me", body=request_body).execute()
+            # the response has the mailbox's current historyId, our starting point for incremental syncs
+            return service.users().watch(userId="me", body=request_body).execute()
         except Exception as e:
             print(e)
         
@@ -65,15 +78,15 @@ class GmailClient(BaseGoogleClient):
 
         return (final_headers, final_body)
     
-    def get_email_ids(self):
+    def get_email_ids(self, max_results: int = 10):
         service = self._get_service()
 
-        # get the last 10 email ids
+        # get the last max_results email ids
         try:
             result = service.users().messages().list(
                     userId="me",
                     labelIds=["INBOX"],
-                    maxResults=10
+                    maxResults=max_results
                 ).execute()
 
             messages = result.get("messages", [])
@@ -91,35 +104,106 @@ class GmailClient(BaseGoogleClient):
         except Exception as e:
             print(e)
     
-    def get_emails(self, email_ids: list[str]):
+    # get the ids of the inbox messages added since start_history_id and the latest history id
+    # returns None if the history id is too old and we need a full sync instead
+    def get_history_email_ids(self, start_history_id: str):
         service = self._get_service()
 
-        if len(email_ids) == 0:
+        message_ids = []
+        latest_history_id = start_history_id
+        page_token = None
+
+        try:
+            while True:
+                result = service.users().history().list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    labelId="INBOX",
+                    pageToken=page_token
+                ).execute()
+
+                for history in result.get("history", []):
+                    for added in history.get("messagesAdded", []):
+                        message_id = added.get("message", {}).get("id")
+
+                        if message_id and message_id not in message_ids:
+                            message_ids.append(message_id)
+
+                latest_history_id = result.get("historyId", latest_history_id)
+                page_token = result.get("nextPageToken")
+
+                if not page_token:
+                    break
+
+            return message_ids, latest_history_id
+
+        except HttpError as e:
+            # gmail only keeps about a week of history, a 404 means start_history_id expired
+            if e.resp.status == 404:
+                print(f"history id {start_history_id} expired")
+            else:
+                print(e)
             return None
 
+    # returns (emails, ids that couldn't be fetched), anything that fails the whole request is raised
+    # so the caller knows emails are missing and doesn't move its history id past them
+    def get_emails(self, email_ids: list[str]):
+        failed_ids = []
+
+        if len(email_ids) == 0:
+            return [], failed_ids
+
         # from the email ids, get and format email objects
-        try:
-            emails = []
-            for i in email_ids:
-                single_email = service.users().messages().get(userId="me", id=i).execute()
+        emails = list(self.iter_emails(email_ids, failed_ids=failed_ids))
+
+        return emails, failed_ids
+
+    # fetch emails through the gmail batch endpoint and yield each one as soon as its batch is parsed
+    # the ids whose get failed are added to failed_ids
+    def iter_emails(self, email_ids: list[str], batch_size: int = GMAIL_BATCH_SIZE, email_format: str = "full", failed_ids: list | None = None):
+        service = self._get_service()
+
+        batch_size = min(batch_size, GMAIL_MAX_BATCH_SIZE)
+
+        for start in range(0, len(email_ids), batch_size):
+            batch_ids = email_ids[start:start + batch_size]
+            responses = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    print(f"failed to get email {request_id}: {exception}")
+                    if failed_ids is not None:
+                        failed_ids.append(request_id)
+                    return
+
+                responses[request_id] = response
+
+            batch = service.new_batch_http_request(callback=callback)
+
+            for i in batch_ids:
+                # only transfer the headers and the text parts we use in _format_email
+                batch.add(
+                    service.users().messages().get(userId="me", id=i, format=email_format, fields=EMAIL_FIELDS[email_format]),
+                    request_id=i,
+                )
+
+            batch.execute()
+
+            # keep the order of the ids we were given
+            for i in batch_ids:
+                if i not in responses:
+                    continue
 
                 # get email contents for the returned email object
-                headers, body = self._format_email(single_email)
+                headers, body = self._format_email(responses[i])
 
-                single_email_obj = {
+                yield {
                     "id": i,
                     "headers": headers,
                     "body": body.get("body"),
                 }
 
-
-                emails.append(single_email_obj)
-
-            return emails
-        
-        except Exception as e:
-            print(e)
-
     def create_email(
         self,
         to: str,
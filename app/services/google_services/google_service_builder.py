@@ -1,8 +1,6 @@
-from datetime import datetime
-import os
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from app.services.google_services.credential_cache import build_credentials, credential_cache
+from app.services.google_services.service_cache import service_cache
 
 class GoogleServiceBuilder():
     def __init__(self, service_name: str, service_version: str, credential_manager, user_id: str, scopes: list[str]):
@@ -11,11 +9,6 @@ class GoogleServiceBuilder():
         self.service_name = service_name
         self.service_version = service_version
 
-        # for credentials obj
-        self.client_id = os.environ.get("OAUTH_CLIENT2_ID")
-        self.client_secret = os.environ.get("OAUTH_CLIENT2_SECRET")
-        self.token_uri = "https://oauth2.googleapis.com/token"
-
         #used to get usre's token to build credentials object
         self.credential_manager = credential_manager
         self.user_credentials = None
@@ -23,33 +16,36 @@ class GoogleServiceBuilder():
 
 
     def _build_credentials_object(self):
+        # the token refresh scheduler keeps the cached credentials fresh, so most calls stop here
+        cached_credentials = credential_cache.get(self.user_id)
+
+        if cached_credentials:
+            self.user_credentials = cached_credentials
+            return
+
         token = self.credential_manager.get_google_tokens(self.user_id)
 
-        self.user_credentials = Credentials(
-            token = token['google_access_token'],
-            refresh_token = token['google_refresh_token'],
-            token_uri = self.token_uri,
-            client_id = self.client_id,
-            client_secret= self.client_secret,
-            scopes= self.scopes,
-        )
-        
-        self.user_credentials.expiry = datetime.fromisoformat(token['expiry'])
+        self.user_credentials = build_credentials(token, scopes=self.scopes)
+
+        credential_cache.set(self.user_id, self.user_credentials)
 
         print("succesfully built credentials object")
 
 
     def create_client(self):
-        # if there's not a credentials objnect build it
-        if not self.user_credentials:
+        # if there's not a credentials objnect (or it expired) get it from the cache or db
+        if not self.user_credentials or self.user_credentials.expired:
             self._build_credentials_object()
 
-        # if the token is expired refresh it and update the database
+        # if the token is still expired the scheduler didn't get to it, refresh it and update the database
         if self.user_credentials.expired and self.user_credentials.refresh_token:
             self.user_credentials.refresh(Request())
             self.credential_manager.add_google_tokens(self.user_id, self.user_credentials.token, self.user_credentials.refresh_token, self.user_credentials.expiry)
 
-        print('building client')
+            credential_cache.set(self.user_id, self.user_credentials)
+
+            # services built with the old token are stale now
+            service_cache.evict_user(self.user_id)
 
-        #build gmail service
-        return build(self.service_name, self.service_version, credentials=self.user_credentials)
\ No newline at end of file
+        # reuse the service for this user if we've already built it
+        return service_cache.get_service(self.user_id, self.service_name, self.service_version, self.user_credentials)
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from functools import lru_cache
+import json
+import os
+import threading
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+
+# parse the discovery document shipped with google-api-python-client once per process
+# instead of reading it from disk (or fetching it) on every build
+@lru_cache(maxsize=None)
+def get_discovery_document(service_name: str, service_version: str):
+    document = get_static_doc(service_name, service_version)
+
+    if document is None:
+        raise ValueError(f"no static discovery document for {service_name} {service_version}")
+
+    return json.loads(document)
+
+
+class GoogleServiceCache:
+    def __init__(self, max_size: int | None = None):
+        self.max_size = max_size or int(os.getenv("GOOGLE_SERVICE_CACHE_SIZE", 256))
+        self.lock = threading.Lock()
+
+        # (user_id, service_name, service_version, thread_id) -> (access token, service)
+        # httplib2 is not thread safe so every thread gets its own service object
+        self.services = OrderedDict()
+
+    def _key(self, user_id: str, service_name: str, service_version: str):
+        return (user_id, service_name, service_version, threading.get_ident())
+
+    def get_service(self, user_id: str, service_name: str, service_version: str, credentials):
+        key = self._key(user_id, service_name, service_version)
+
+        with self.lock:
+            entry = self.services.get(key)
+
+            # only reuse the service if it was built with the current token
+            if entry and entry[0] == credentials.token:
+                self.services.move_to_end(key)
+                return entry[1]
+
+        print(f"building {service_name} {service_version} service for {user_id}")
+
+        service = build_from_document(
+            get_discovery_document(service_name, service_version),
+            credentials=credentials,
+        )
+
+        with self.lock:
+            self.services[key] = (credentials.token, service)
+            self.services.move_to_end(key)
+
+            # drop the least recently used services
+            while len(self.services) > self.max_size:
+                self.services.popitem(last=False)
+
+        return service
+
+    #remove every cached service for a user, used when their token is refreshed
+    def evict_user(self, user_id: str):
+        with self.lock:
+            for key in [key for key in self.services if key[0] == user_id]:
+                del self.services[key]
+
+
+service_cache = GoogleServiceCache()
@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from app.utils.task_queue import OrchestratorStreamConsumer
+
+
+# runs the tasks of one chat strictly in order while different chats run in parallel
+# each chat gets a mailbox (ordered by the chat's sequence numbers) drained by a single runner task,
+# and the runner waits for the chat's earlier tasks to finish on any worker before starting the next one
+# an entry is heartbeated from the moment it's submitted, so one waiting in a mailbox isn't claimed by another worker
+class ChatScheduler:
+    def __init__(self, consumer: OrchestratorStreamConsumer, concurrency: int):
+        self.consumer = consumer
+
+        # bounds how many tasks execute at once, tasks waiting for their turn don't hold a slot
+        self.slots = asyncio.Semaphore(concurrency)
+
+        # give up waiting for an earlier task after this long so a lost task can't block a chat forever
+        # a failing task is retried every visibility timeout until it's dead lettered after max_deliveries,
+        # waiting less than that lets the chat's next task run before the earlier one's retries
+        retry_window = consumer.visibility_timeout / 1000 * (consumer.max_deliveries + 1)
+        self.order_timeout = float(os.getenv("ORCHESTRATOR_ORDER_TIMEOUT", retry_window))
+
+        if self.order_timeout < retry_window:
+            print(f"ORCHESTRATOR_ORDER_TIMEOUT ({self.order_timeout}s) is shorter than the retry window ({retry_window}s), a chat's tasks can run out of order")
+
+        self.mailboxes: dict[str, list] = {}
+        self.runners: dict[str, asyncio.Task] = {}
+        self.counter = itertools.count()
+
+        # entry id -> heartbeat of an entry that's queued or running here
+        self.heartbeats: dict = {}
+
+    # job is an async callable that runs the task
+    # returns False if the entry is already queued or running here (we reclaimed our own entry), the copy is dropped
+    def submit(self, chat_id: str | None, seq: int | None, job, entry_id=None) -> bool:
+        if entry_id is not None:
+            if entry_id in self.heartbeats:
+                print(f"task {entry_id} is already queued, dropping the redelivered copy")
+                return False
+
+            self.heartbeats[entry_id] = asyncio.create_task(self._heartbeat(entry_id))
+
+        # tasks without a chat id (or dispatched before tasks were numbered) get a mailbox of their own
+        key = chat_id if chat_id is not None else f"unordered:{next(self.counter)}"
+
+        heapq.heappush(self.mailboxes.setdefault(key, []), (seq or 0, next(self.counter), entry_id, job))
+
+        if key not in self.runners:
+            self.runners[key] = asyncio.create_task(self._drain(key, chat_id))
+
+        return True
+
+    # keep the entry from looking stuck while it waits for its turn and while it runs
+    async def _heartbeat(self, entry_id):
+        while True:
+            await asyncio.sleep(self.consumer.visibility_timeout / 3000)
+
+            try:
+                await self.consumer.heartbeat(entry_id)
+            except Exception as e:
+                print(f"Error heartbeating task {entry_id}: {e}")
+
+    # returns False if an earlier task of the chat showed up in the mailbox while we were waiting
+    # the timeout counts from stalled_since, when the chat last made progress, so it doesn't restart with every new head
+    async def _wait_for_turn(self, mailbox: list, chat_id: str | None, seq: int | None, stalled_since: float) -> bool:
+        deadline = stalled_since + self.order_timeout
+        delay = 0.05
+
+        while not await self.consumer.is_turn(chat_id, seq):
+            if mailbox[0][0] != (seq or 0):
+                return False
+
+            if time.monotonic() >= deadline:
+                print(f"timed out waiting for the earlier tasks of chat {chat_id}, running task {seq}")
+                return True
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
+
+        return True
+
+    async def _drain(self, key: str, chat_id: str | None):
+        mailbox = self.mailboxes[key]
+        stalled_since = time.monotonic()
+
+        try:
+            while mailbox:
+                seq = mailbox[0][0]
+
+                if not await self._wait_for_turn(mailbox, chat_id, seq or None, stalled_since):
+                    continue
+
+                _, _, entry_id, job = heapq.heappop(mailbox)
+
+                try:
+                    async with self.slots:
+                        try:
+                            await job()
+                        except Exception as e:
+                            print(f"Error running task {seq} of chat {chat_id}: {e}")
+                finally:
+                    heartbeat = self.heartbeats.pop(entry_id, None)
+                    if heartbeat is not None:
+                        heartbeat.cancel()
+
+                stalled_since = time.monotonic()
+        finally:
+            del self.runners[key]
+            del self.mailboxes[key]
+
+    def pending(self) -> int:
+        return sum(len(mailbox) for mailbox in self.mailboxes.values()) + len(self.runners)
+
+    # wait for everything submitted so far, used on shutdown
+    async def join(self, timeout: float | None = None):
+        if self.runners:
+            await asyncio.wait(list(self.runners.values()), timeout=timeout)
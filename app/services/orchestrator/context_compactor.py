@@ -0,0 +1,159 @@
+from datetime import datetime, timezone
+import json
+import os
+from typing import Any
+from app.services.prompts.prompts import prompt_dict
+
+# prompt size the orchestrator aims for, in (estimated) tokens
+ORCHESTRATOR_CONTEXT_BUDGET = int(os.getenv("ORCHESTRATOR_CONTEXT_BUDGET", 16000))
+
+# the last messages always go to the model exactly as they were logged
+ORCHESTRATOR_KEEP_RECENT = int(os.getenv("ORCHESTRATOR_KEEP_RECENT", 6))
+
+# tool results above this are cut down, route step lists and raw gmail responses are mostly noise to the model
+ORCHESTRATOR_TOOL_RESULT_TOKENS = int(os.getenv("ORCHESTRATOR_TOOL_RESULT_TOKENS", 1000))
+
+# running summaries expire with the task
+CONTEXT_SUMMARY_TTL = 7 * 24 * 60 * 60
+CONTEXT_SUMMARY_KEY = "context_summary:{task_id}"
+
+# prompt tokens saved by compaction, per task (expires with the task's summary) and per day
+CONTEXT_SAVINGS_KEY = "context_savings:{task_id}"
+CONTEXT_DAILY_SAVINGS_KEY = "orchestrator_context_savings:{day}"
+CONTEXT_DAILY_SAVINGS_TTL = 30 * 24 * 60 * 60
+
+
+# rough count, about 4 characters per token for english and json
+def estimate_tokens(messages: list[dict]) -> int:
+    return sum(len(json.dumps(message, default=str)) for message in messages) // 4
+
+
+def truncate_tool_result(message: dict, max_tokens: int) -> dict:
+    content = message.get("content")
+    max_chars = max_tokens * 4
+
+    if message.get("role") != "tool" or not isinstance(content, str) or len(content) <= max_chars:
+        return message
+
+    return {**message, "content": f"{content[:max_chars]}... [truncated {len(content) - max_chars} characters]"}
+
+
+# fits the task's messages into a token budget before they go to the model
+# the system prompt and the recent messages stay exact, older steps are rolled into a running summary
+# that's cached per task so every iteration only summarises the steps that fell out of the recent window
+class ContextCompactor:
+    def __init__(
+        self,
+        client: Any,
+        redis_client: Any = None,
+        token_budget: int = ORCHESTRATOR_CONTEXT_BUDGET,
+        keep_recent: int = ORCHESTRATOR_KEEP_RECENT,
+        max_tool_result_tokens: int = ORCHESTRATOR_TOOL_RESULT_TOKENS,
+    ):
+        #AsyncOpenAI client for the summaries and an async redis client to keep them between runs of the task
+        self.client = client
+        self.r = redis_client
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.max_tool_result_tokens = max_tool_result_tokens
+
+        # used when there's no redis
+        self.summaries: dict[str, dict] = {}
+
+        self.tokens_saved = 0
+
+    async def compact(self, task_id: str, messages: list[dict]) -> list[dict]:
+        original_tokens = estimate_tokens(messages)
+
+        compacted = [messages[0]] + [truncate_tool_result(message, self.max_tool_result_tokens) for message in messages[1:]]
+
+        if estimate_tokens(compacted) > self.token_budget:
+            cut = self._recent_start(compacted)
+
+            if cut > 1:
+                try:
+                    summary = await self._summary(task_id, compacted, cut)
+                    compacted = [
+                        compacted[0],
+                        {"role": "system", "content": f"Summary of the earlier steps of this task:\n{summary}"},
+                        *compacted[cut:],
+                    ]
+                except Exception as e:
+                    # too long is better than failing the task
+                    print(f"Error summarising task {task_id}: {e}")
+
+        saved = original_tokens - estimate_tokens(compacted)
+        if saved > 0:
+            self.tokens_saved += saved
+            await self._record_savings(task_id, saved)
+
+        return compacted
+
+    # index of the first recent message, a tool result can't be separated from the tool call before it
+    def _recent_start(self, messages: list[dict]) -> int:
+        cut = max(1, len(messages) - self.keep_recent)
+
+        while cut > 1 and messages[cut].get("role") == "tool":
+            cut -= 1
+
+        return cut
+
+    # summary of messages[1:cut], extending the cached summary with the steps that are new since it was written
+    async def _summary(self, task_id: str, messages: list[dict], cut: int) -> str:
+        cached = await self._get_cached(task_id)
+
+        # the cache covers messages[1:upto], anything it doesn't cover (or a cache from a longer window) is redone
+        if cached and cached["upto"] <= cut:
+            summary, start = cached["summary"], cached["upto"]
+        else:
+            summary, start = "", 1
+
+        if start < cut:
+            summary = await self._summarise(summary, messages[start:cut])
+            await self._set_cached(task_id, {"summary": summary, "upto": cut})
+
+        return summary
+
+    async def _summarise(self, previous: str, steps: list[dict]) -> str:
+        steps_text = "\n".join(json.dumps(step, default=str) for step in steps)
+
+        response = await self.client.chat.completions.create(
+            model="gpt-5-nano",
+            messages=[
+                {"role": "system", "content": prompt_dict["context_summary_prompt"]},
+                {"role": "user", "content": f"Summary so far:\n{previous or '(none)'}\n\nNew steps:\n{steps_text}"},
+            ],
+        )
+
+        return response.choices[0].message.content
+
+    async def _get_cached(self, task_id: str) -> dict | None:
+        if self.r is None:
+            return self.summaries.get(task_id)
+
+        cached = await self.r.get(CONTEXT_SUMMARY_KEY.format(task_id=task_id))
+        return json.loads(cached) if cached else None
+
+    async def _set_cached(self, task_id: str, value: dict):
+        if self.r is None:
+            self.summaries[task_id] = value
+            return
+
+        await self.r.set(CONTEXT_SUMMARY_KEY.format(task_id=task_id), json.dumps(value), ex=CONTEXT_SUMMARY_TTL)
+
+    async def _record_savings(self, task_id: str, saved: int):
+        if self.r is None:
+            return
+
+        task_key = CONTEXT_SAVINGS_KEY.format(task_id=task_id)
+        daily_key = CONTEXT_DAILY_SAVINGS_KEY.format(day=datetime.now(timezone.utc).date().isoformat())
+
+        try:
+            pipe = self.r.pipeline()
+            pipe.incrby(task_key, saved)
+            pipe.expire(task_key, CONTEXT_SUMMARY_TTL)
+            pipe.incrby(daily_key, saved)
+            pipe.expire(daily_key, CONTEXT_DAILY_SAVINGS_TTL)
+            await pipe.execute()
+        except Exception as e:
+            print(f"Error recording context savings: {e}")
@@ -1,38 +1,83 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import signal
 from dotenv import load_dotenv
-from openai import OpenAI
-import redis
+from openai import AsyncOpenAI
+import redis.asyncio as aioredis
 
+from app.services.orchestrator.memory import flush_pending_writes
 from app.services.orchestrator.orchestrator_agent import OrchestratorAgent
 from app.services.tools import tool_definitions, tool_dict
 from app.services.prompts.prompts import prompt_dict
+from app.services.orchestrator.chat_scheduler import ChatScheduler
+from app.utils.task_queue import OrchestratorStreamConsumer
 
 load_dotenv()
 
-client = OpenAI()
-
 redis_host = os.getenv("REDIS_HOST", "localhost")
 
-r = redis.Redis(host=redis_host, port=6379, db=0)
+# how many tasks run at the same time and how many threads the blocking tools / supabase calls get
+ORCHESTRATOR_CONCURRENCY = int(os.getenv("ORCHESTRATOR_CONCURRENCY", 16))
+ORCHESTRATOR_THREADS = int(os.getenv("ORCHESTRATOR_THREADS", 32))
+
+# how many tasks we take from the stream at once, including the ones waiting for an earlier task of their chat
+ORCHESTRATOR_MAX_INFLIGHT = int(os.getenv("ORCHESTRATOR_MAX_INFLIGHT", ORCHESTRATOR_CONCURRENCY * 4))
+
+# seconds we give running tasks to finish on shutdown
+ORCHESTRATOR_SHUTDOWN_TIMEOUT = float(os.getenv("ORCHESTRATOR_SHUTDOWN_TIMEOUT", 60))
 
 
-while True:
+# fields every task needs, a task without them fails the same way on every delivery
+REQUIRED_PACKET_FIELDS = ("task_id", "user_id", "chat_id", "content")
 
-    print("exec file running")
-    #get data from queue
-    _, raw_data = r.blpop('orchestrator_queue') 
-    print(raw_data)
-    
-    #define packet to send the agent
+
+# raises ValueError for a task that can never run
+def parse_packet(raw_data) -> dict:
     packet = json.loads(raw_data)
-    print(f"Received task: {packet['task_id']}")
-    
-    #initialise the agent
-    orchestrator = OrchestratorAgent(name="OrchestratorAgent",client=client ,tool_definitions=tool_definitions, tool_dict=tool_dict, prompt=prompt_dict["reasoning_agent_prompt"], user_id=packet["user_id"], chat_id=packet["chat_id"])
 
-    #call function to run the loop
-    result = orchestrator.receive_message(packet)
+    if not isinstance(packet, dict):
+        raise ValueError("task is not a json object")
+
+    missing = [field for field in REQUIRED_PACKET_FIELDS if not packet.get(field)]
+    if missing:
+        raise ValueError(f"task is missing {', '.join(missing)}")
+
+    return packet
+
+
+async def handle_packet(client: AsyncOpenAI, r: aioredis.Redis, packet: dict, entry_id: str):
+    orchestrator = None
+
+    try:
+        print(f"Received task: {packet['task_id']}")
+
+        #initialise the agent, it loads the chat history so it's built off the event loop
+        orchestrator = await asyncio.to_thread(
+            OrchestratorAgent,
+            name="OrchestratorAgent",
+            client=client,
+            tool_definitions=tool_definitions,
+            tool_dict=tool_dict,
+            prompt=prompt_dict["reasoning_agent_prompt"],
+            user_id=packet["user_id"],
+            chat_id=packet["chat_id"],
+            publisher=r,
+            redis_client=r,
+        )
+
+        #call function to run the loop
+        result = await orchestrator.receive_message(packet, entry_id)
+
+    except Exception as e:
+        print(f"Error running task {packet['task_id']}: {e}")
+
+        if orchestrator is not None:
+            #so the retry finds the steps that were logged
+            await orchestrator.flush()
+
+        return False
 
     result_dump = json.dumps(result)
 
@@ -40,6 +85,92 @@ while True:
 
     print(result)
 
-    #oublish it
-    r.publish(packet['chat_id'], result_dump)
-    
\ No newline at end of file
+    #publish it, the user gets the answer before the process log is written
+    await r.publish(packet['chat_id'], result_dump)
+
+    #the chat's next task (e.g. the answer to an ask_user) runs after the ack and reads these steps
+    await orchestrator.flush()
+
+    return True
+
+
+# run the task and ack it once it's done, failed tasks stay pending and get retried or dead lettered
+# the scheduler heartbeats the entry from when it's submitted until this returns
+async def handle_entry(client: AsyncOpenAI, r: aioredis.Redis, consumer: OrchestratorStreamConsumer, entry_id, raw_data, chat_id, seq):
+    try:
+        packet = parse_packet(raw_data)
+    except ValueError as e:
+        # json.JSONDecodeError is a ValueError too
+        print(f"Rejecting task {entry_id}: {e}")
+        await consumer.reject(entry_id, raw_data, chat_id, seq)
+        return
+
+    if await handle_packet(client, r, packet, entry_id.decode("utf-8") if isinstance(entry_id, bytes) else entry_id):
+        # acking also lets the chat's next task run
+        await consumer.ack(entry_id, chat_id, seq)
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+
+    # asyncio.to_thread uses the default executor, bound it so blocking calls can't spawn unlimited threads
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ORCHESTRATOR_THREADS))
+
+    client = AsyncOpenAI()
+    r = aioredis.Redis(host=redis_host, port=6379, db=0)
+
+    consumer = OrchestratorStreamConsumer(r)
+    await consumer.setup()
+
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # tasks of the same chat run in order, different chats run in parallel
+    scheduler = ChatScheduler(consumer, ORCHESTRATOR_CONCURRENCY)
+    inflight = asyncio.Semaphore(ORCHESTRATOR_MAX_INFLIGHT)
+
+    print(f"exec file running with {ORCHESTRATOR_CONCURRENCY} concurrent tasks")
+
+    while not stop_event.is_set():
+        # only take a task when we have room for it, otherwise leave it in the stream for other workers
+        await inflight.acquire()
+
+        #get data from the stream, the timeout lets us check for shutdown
+        try:
+            item = await consumer.read(block_ms=1000)
+        except Exception as e:
+            print(f"Error reading orchestrator stream: {e}")
+            item = None
+            await asyncio.sleep(1)
+
+        if item is None:
+            inflight.release()
+            continue
+
+        entry_id, raw_data, chat_id, seq = item
+        print(raw_data)
+
+        async def job(entry_id=entry_id, raw_data=raw_data, chat_id=chat_id, seq=seq):
+            try:
+                await handle_entry(client, r, consumer, entry_id, raw_data, chat_id, seq)
+            finally:
+                inflight.release()
+
+        if not scheduler.submit(chat_id, seq, job, entry_id):
+            inflight.release()
+
+    # graceful shutdown, stop taking tasks and let the running ones finish
+    # anything still running after the timeout stays pending and gets claimed by another worker
+    print(f"exec file shutting down, waiting for {scheduler.pending()} tasks")
+    await scheduler.join(timeout=ORCHESTRATOR_SHUTDOWN_TIMEOUT)
+
+    # anything left over stays staged in redis for the next start
+    await asyncio.to_thread(flush_pending_writes, ORCHESTRATOR_SHUTDOWN_TIMEOUT)
+
+    await r.aclose()
+    await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,66 +1,432 @@
+from itertools import takewhile
 import os
-from supabase import Client, create_client
+from postgrest.exceptions import APIError
+from supabase import Client
 from datetime import datetime, timezone
 from uuid import uuid4
+from app.utils.chat_history_cache import chat_history_cache, parse_timestamp
+from app.utils.supabase_pool import get_supabase_client
+from app.utils.write_behind import WriteBehindBuffer
+
+# "array" keeps the messages in the chats.messages json column, "rows" stores one chat_messages row per message
+# run app.services.orchestrator.migrate_chat_messages before switching to rows
+CHAT_STORAGE = os.getenv("CHAT_STORAGE", "array")
+CHAT_MESSAGES_TABLE = "chat_messages"
+
+# postgrest returns at most 1000 rows per request
+CHAT_MESSAGES_PAGE_SIZE = 1000
+CHAT_APPEND_RETRIES = 3
+
+# process logs and chat messages are written in batches by a background thread instead of one request per record
+# staged in redis until they're written when durable, so a crash doesn't lose them
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+WRITE_BEHIND_DURABLE = os.getenv("WRITE_BEHIND_DURABLE", "true").lower() == "true"
+
+# assistant_tool_call steps store just the assistant message with its tool calls
+def assistant_tool_call_record(completion) -> dict:
+    message = completion.choices[0].message
+
+    return {
+        "message": {
+            "role": "assistant",
+            "content": message.content,
+            "tool_calls": [
+                {
+                    "id": tool_call.id,
+                    "type": "function",
+                    "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments},
+                }
+                for tool_call in message.tool_calls or []
+            ],
+        }
+    }
+
+
+# usage steps record what each model call cost and how long it took, the model never sees them
+def usage_record(completion, latency: float) -> dict:
+    usage = completion.usage
+
+    return {
+        "completion_id": completion.id,
+        "model": completion.model,
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "completion_tokens": usage.completion_tokens if usage else None,
+        "total_tokens": usage.total_tokens if usage else None,
+        "latency_ms": round(latency * 1000),
+    }
+
+
+# turn a process log step into the message the model expects, None for steps the model doesn't see
+def process_log_message(step_type: str, payload):
+    if step_type == 'user':
+        return {"role": "user", "content": payload}
+
+    elif step_type == 'thought':
+        return {"role": "assistant", "content": payload}
+
+    elif step_type == 'assistant_tool_call':
+        # older rows hold the whole completion
+        if 'choices' in payload:
+            return payload['choices'][0]['message']
+
+        return payload['message']
+
+    elif step_type == 'tool_result':
+        return {
+            "role": "tool",
+            "tool_call_id": payload.get("tool_call_id"),
+            "content": payload.get("content")
+        }
+
+    return None
+
 
 class ConversationManager:
     def __init__(self, chat_id:str, user_id: str):
-        self.url = os.environ.get("SUPABASE_URL")
-        self.key = os.environ.get("SUPABASE_API_KEY")
-
         self.user_id = user_id
         self.chat_id = chat_id
 
-        self.client: Client = create_client(self.url, self.key)
+        self.client: Client = get_supabase_client()
+
+        # the history is only loaded when something reads it, most agents only write
+        self._messages = None
 
-        self.messages = self._load_message_history()
+    @property
+    def messages(self):
+        if self._messages is None:
+            messages = self._load_message_history()
 
-    # get conversation messages from database
+            # couldn't load it, the next read tries again
+            if messages is None:
+                return []
+
+            self._messages = messages
+
+        return self._messages
+
+    # get conversation messages from the cache, or from the database on a miss
+    # None if the database couldn't be read, nothing is cached then so a transient error doesn't look like an empty chat
     def _load_message_history(self):
+        try:
+            cached = chat_history_cache.get(self.chat_id)
+            if cached is not None:
+                return cached
+
+            version = chat_history_cache.version(self.chat_id)
+        except Exception as e:
+            print(f"chat history cache unavailable: {e}")
+            version = None
+
+        try:
+            messages = self._fetch_message_history()
+        except Exception as e:
+            print(f"Error loading chat history for {self.chat_id}: {e}")
+            return None
+
+        if version is not None:
+            try:
+                chat_history_cache.fill(self.chat_id, messages, version)
+            except Exception as e:
+                print(f"Error caching chat history: {e}")
+
+        return messages
+
+    # raises on anything but a chat that doesn't exist yet
+    def _fetch_message_history(self):
+        if CHAT_STORAGE == "rows":
+            return self._fetch_message_rows()
+
         try:
             response = (
                 self.client.table("chats").select("messages").eq("chat_id", self.chat_id).single().execute()
                 )
 
-            return response.data['messages'] if response.data else []
-        except Exception:
-            return []
+            messages = response.data['messages'] if response.data else []
+        except APIError as e:
+            # .single() found no row
+            if e.code == "PGRST116":
+                return []
+            raise
+
+        # a chat with a single message is stored as an object
+        if isinstance(messages, dict):
+            messages = [messages]
+
+        return messages or []
+
+    # every message row of the chat in seq order, a page at a time since postgrest caps the rows per request
+    # a failed page raises, a partial history must not end up in the cache
+    def _fetch_message_rows(self):
+        messages = []
+
+        while True:
+            page = (
+                self._message_rows().order("seq")
+                .range(len(messages), len(messages) + CHAT_MESSAGES_PAGE_SIZE - 1)
+                .execute()
+            ).data or []
+
+            messages.extend(page)
+
+            if len(page) < CHAT_MESSAGES_PAGE_SIZE:
+                return messages
+
+    # make sure the history is in the cache, returns (message count, last message)
+    # None if the cache is unavailable, callers then fall back to self.messages
+    def history_state(self):
+        try:
+            state = chat_history_cache.stat(self.chat_id)
+            if state is None:
+                self._load_message_history()
+                state = chat_history_cache.stat(self.chat_id)
+
+            return state
+        except Exception as e:
+            print(f"chat history cache unavailable: {e}")
+            return None
+
+    # newest first page of messages before the cursor (a message's seq), and the cursor of the next page
+    def get_message_page(self, before: int | None, limit: int):
+        state = self.history_state()
+
+        if state is None:
+            return self._fallback_page(before, limit)
+
+        count, _ = state
+        end = count if before is None else max(0, min(before, count))
+        start = max(0, end - limit)
+
+        page = chat_history_cache.range(self.chat_id, start, end - 1) if end > start else []
+
+        return page[::-1], (start if start > 0 else None)
+
+    # oldest first messages after a message id or timestamp, None if the message id isn't known
+    def get_messages_since(self, since: str, limit: int):
+        state = self.history_state()
+
+        if state is None:
+            return self._fallback_since(since, limit)
+
+        count, _ = state
+        start = chat_history_cache.position_after(self.chat_id, since)
+
+        if start is None:
+            return None, False
+
+        page = chat_history_cache.range(self.chat_id, start, start + limit - 1) if start < count else []
+
+        return page, start + limit < count
+
+    # without the cache, message rows are queried by seq and arrays are sliced in python
+    def _fallback_page(self, before: int | None, limit: int):
+        if CHAT_STORAGE == "rows":
+            query = self._message_rows().order("seq", desc=True).limit(limit)
+            if before is not None:
+                query = query.lt("seq", before)
+
+            page = query.execute().data or []
+
+            return page, (page[-1]["seq"] if page and page[-1]["seq"] > 0 else None)
+
+        messages = [{**message, "seq": seq} for seq, message in enumerate(self.messages)]
+        end = len(messages) if before is None else max(0, min(before, len(messages)))
+        start = max(0, end - limit)
+
+        return messages[start:end][::-1], (start if start > 0 else None)
+
+    def _fallback_since(self, since: str, limit: int):
+        try:
+            parse_timestamp(since)
+            is_timestamp = True
+        except ValueError:
+            is_timestamp = False
+
+        if CHAT_STORAGE == "rows":
+            query = self._message_rows().order("seq").limit(limit + 1)
+
+            if is_timestamp:
+                query = query.gt("timestamp", since)
+            else:
+                marker = self.client.table(CHAT_MESSAGES_TABLE).select("seq").eq("chat_id", self.chat_id).eq("id", since).limit(1).execute()
+                if not marker.data:
+                    return None, False
+                query = query.gt("seq", marker.data[0]["seq"])
+
+            page = query.execute().data or []
+
+            return page[:limit], len(page) > limit
+
+        messages = [{**message, "seq": seq} for seq, message in enumerate(self.messages)]
+
+        if is_timestamp:
+            score = parse_timestamp(since)
+            start = next((seq for seq, message in enumerate(messages) if parse_timestamp(message["timestamp"]) > score), len(messages))
+        else:
+            start = next((seq + 1 for seq, message in enumerate(messages) if message.get("id") == since), None)
+            if start is None:
+                return None, False
+
+        return messages[start:start + limit], start + limit < len(messages)
+
+    def _message_rows(self):
+        return self.client.table(CHAT_MESSAGES_TABLE).select("id, seq, role, content, timestamp").eq("chat_id", self.chat_id)
+
+    # one bulk insert, the seqs follow the chat's last row
+    # two writers racing for the same seq hit the (chat_id, seq) primary key and the loser retries
+    def _append_message_rows(self, messages: list[dict]):
+        for attempt in range(CHAT_APPEND_RETRIES):
+            last = (
+                self.client.table(CHAT_MESSAGES_TABLE).select("seq")
+                .eq("chat_id", self.chat_id).order("seq", desc=True).limit(1)
+                .execute()
+            ).data
+            seq = last[0]["seq"] + 1 if last else 0
+
+            #first message, the chats row still owns the chat
+            if seq == 0:
+                print(f"creting new chat: {self.chat_id}")
+                self.client.table("chats").upsert(
+                    {"chat_id": self.chat_id, "user_id": self.user_id, "messages": []},
+                    on_conflict="chat_id", ignore_duplicates=True
+                ).execute()
+
+            try:
+                self.client.table(CHAT_MESSAGES_TABLE).insert([
+                    {**message, "chat_id": self.chat_id, "seq": seq + i} for i, message in enumerate(messages)
+                ]).execute()
+                return
+            except APIError as e:
+                # unique violation, someone else took this seq
+                if e.code != "23505" or attempt == CHAT_APPEND_RETRIES - 1:
+                    raise
+
+    # the existence flag saves downloading the history on every write
+    # buffered writes can't use it, the flag is set as soon as a message is cached
+    def _chat_exists(self, use_cache: bool = True):
+        if use_cache:
+            try:
+                exists = chat_history_cache.exists(self.chat_id)
+                if exists is not None:
+                    return exists
+            except Exception as e:
+                print(f"chat history cache unavailable: {e}")
+
+        # a miss only needs the row, not the messages
+        response = self.client.table("chats").select("chat_id").eq("chat_id", self.chat_id).limit(1).execute()
+
+        return bool(response.data)
+
+    # ids of these messages that are already in the chats.messages array
+    # messages are appended in order, so if the first one isn't there none of them are and one cheap check is enough
+    def _stored_message_ids(self, messages: list[dict]) -> set:
+        first_id = messages[0].get("id") if messages else None
+        if first_id is None:
+            return set()
+
+        if self._chat_contains([{"id": first_id}]):
+            return {message.get("id") for message in self._fetch_message_history()}
+
+        # a chat with a single message is stored as an object, that message is all there is
+        if self._chat_contains({"id": first_id}):
+            return {first_id}
+
+        return set()
+
+    def _chat_contains(self, value) -> bool:
+        response = (
+            self.client.table("chats").select("chat_id")
+            .eq("chat_id", self.chat_id)
+            .contains("messages", value)
+            .execute()
+        )
+
+        return bool(response.data)
+
+    # write messages of this chat to the database, in order
+    def _store_messages(self, messages: list[dict], use_cache: bool = True):
+        if CHAT_STORAGE == "rows":
+            self._append_message_rows(messages)
+            return
+
+        #if we can't find the a chat with the provided id, create one.
+        if not self._chat_exists(use_cache):
+            print(f"creting new chat: {self.chat_id}")
+
+            #insert first message
+            self.client.table("chats").insert({
+                "chat_id": self.chat_id,
+                "user_id": self.user_id,
+                "messages": messages[0]
+            }).execute()
+            messages = messages[1:]
+
+        else:
+            #a batch that failed partway is retried as a whole, don't append the messages that made it
+            stored_ids = self._stored_message_ids(messages)
+            messages = [message for message in messages if message.get("id") not in stored_ids]
+
+        #else, add the message to the chat 
+        for message in messages:
+            self.client.rpc("add_chat_message", {
+                "p_chat_id": self.chat_id,
+                "p_new_message": message,
+            }).execute();
         
     # add message to database
     def add_message(self, message: str, role: str) -> None:
-        try:
-            date = datetime.now(timezone.utc).isoformat()
-            new_msg_obj = {"role": role, "content": message, "timestamp": date}
+        date = datetime.now(timezone.utc).isoformat()
+        new_msg_obj = {"id": str(uuid4()), "role": role, "content": message, "timestamp": date}
 
-            #if we can't find the a chat with the provided id, create one.
-            if not self._load_message_history():
-                print(f"creting new chat: {self.chat_id}")
+        if WRITE_BEHIND_ENABLED:
+            #readers get the message from the cache straight away, the database gets it with the next batch
+            try:
+                chat_history_cache.add_pending(self.chat_id)
+                chat_history_cache.append(self.chat_id, new_msg_obj)
+            except Exception as e:
+                print(f"Error caching message: {e}")
 
-                #insert first message
-                self.client.table("chats").insert({
-                    "chat_id": self.chat_id,
-                    "user_id": self.user_id,
-                    "messages": new_msg_obj
-                }).execute()
-            #else, add the message to the chat 
-            else:
-                self.client.rpc("add_chat_message", {
-                    "p_chat_id": self.chat_id,
-                    "p_new_message": new_msg_obj,
-                }).execute();
-        except Exception as e:
-            print(f"Error adding message: {e}")
+            chat_message_writes.add({"chat_id": self.chat_id, "user_id": self.user_id, "message": new_msg_obj})
+
+        else:
+            try:
+                self._store_messages([new_msg_obj])
+            except Exception as e:
+                print(f"Error adding message: {e}")
+
+                # we don't know what made it to the database, the next read reloads it
+                try:
+                    chat_history_cache.invalidate(self.chat_id)
+                except Exception:
+                    pass
+                return
+
+            #write-through, the cached history gets the message too
+            try:
+                chat_history_cache.append(self.chat_id, new_msg_obj)
+            except Exception as e:
+                print(f"Error caching message: {e}")
+
+        if self._messages is not None:
+            self._messages.append(new_msg_obj)
     
     #process_log is a table database that acts as the internal memory for the reasoning model
     #add process step into process database
+    # returns the write behind seq of the step when it's buffered
     def add_process_log(self, task_id: str, step_type: str, payload: dict):
+        row = {
+            "task_id": task_id,
+            "chat_id": self.chat_id,
+            "step_type": step_type,
+            "payload": payload
+        }
+
+        if WRITE_BEHIND_ENABLED:
+            # rows of a batch are inserted together, the timestamp keeps them in the order they were logged
+            row["created_at"] = datetime.now(timezone.utc).isoformat()
+            return process_log_writes.add(row)
+
         try:
-            self.client.table("process_log").insert({
-                "task_id": task_id,
-                "chat_id": self.chat_id,
-                "step_type": step_type,
-                "payload": payload
-            }).execute()
+            self.client.table("process_log").insert(row).execute()
         except Exception as e:
             print(f"Error adding process log: {e}")
 
@@ -73,6 +439,7 @@ class ConversationManager:
             print(f"Error getting process log: {e}")
     
     # compile process log into messages expeced from model
+    # also returns the stream entries whose message was logged, a redelivered entry doesn't log it again
     def compile_process_logs(self, task_id: str, system_prompt_text: str):
         # This is system prompt first
         messages = [
@@ -80,31 +447,21 @@ class ConversationManager:
         ]
 
         #  Get history from DB
-        history_rows = self.get_process_log(task_id)
+        history_rows = self.get_process_log(task_id) or []
+        delivered = set()
 
         # reconstruct exact format needed
         for row in history_rows:
-            step_type = row['step_type']
-            payload = row['payload']
-
-            if step_type == 'user':
-                messages.append({"role": "user", "content": payload})
+            if row['step_type'] == 'delivery':
+                delivered.add(row['payload']['entry_id'])
+                continue
 
-            elif step_type == 'thought':
-                messages.append({"role": "assistant", "content": payload})
+            message = process_log_message(row['step_type'], row['payload'])
 
-            elif step_type == 'assistant_tool_call':
-                message_data = payload['choices'][0]['message']
-                messages.append(message_data)
+            if message is not None:
+                messages.append(message)
 
-            elif step_type == 'tool_result':
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": payload.get("tool_call_id"),
-                    "content": payload.get("content")
-                })
-
-        return messages
+        return messages, delivered
 
     # add coords where user's get lost at to the DB
     def add_lost_coords(self, lost_coords, destination, user_id):
@@ -149,4 +506,56 @@ class ConversationManager:
                     }]
                 }).execute()
             except Exception as e:
-                print(f"Error adding coords to table: {e}")
\ No newline at end of file
+                print(f"Error adding coords to table: {e}")
+
+
+def _write_process_logs(rows: list[dict]) -> int:
+    get_supabase_client().table("process_log").insert(rows).execute()
+    return len(rows)
+
+
+# consecutive messages of the same chat go in one call, returns how many were written before a failure
+def _write_chat_messages(records: list[dict]) -> int:
+    written = 0
+
+    try:
+        while written < len(records):
+            chat_id = records[written]["chat_id"]
+            run = list(takewhile(lambda record: record["chat_id"] == chat_id, records[written:]))
+
+            ConversationManager(chat_id, run[0]["user_id"])._store_messages([record["message"] for record in run], use_cache=False)
+            written += len(run)
+
+            try:
+                chat_history_cache.remove_pending(chat_id, len(run))
+            except Exception as e:
+                print(f"chat history cache unavailable: {e}")
+    except Exception as e:
+        print(f"Error adding messages: {e}")
+
+    return written
+
+
+# the cache already has the message the database never got, it's reloaded from the database on the next read
+def _drop_chat_message(record: dict):
+    chat_history_cache.remove_pending(record["chat_id"], 1)
+    chat_history_cache.invalidate(record["chat_id"])
+
+
+process_log_writes = WriteBehindBuffer("process_log", _write_process_logs, chat_history_cache.r if WRITE_BEHIND_DURABLE else None)
+chat_message_writes = WriteBehindBuffer(
+    "chat_messages",
+    _write_chat_messages,
+    chat_history_cache.r if WRITE_BEHIND_DURABLE else None,
+    on_dead_letter=_drop_chat_message,
+)
+
+
+# wait for the buffered process log steps up to seq, a resumed task reads them from the database
+def flush_process_logs(timeout: float | None = None, upto: int | None = None) -> bool:
+    return process_log_writes.flush(timeout, upto)
+
+
+# wait for all the buffered writes, on shutdown
+def flush_pending_writes(timeout: float | None = None) -> bool:
+    return process_log_writes.flush(timeout) and chat_message_writes.flush(timeout)
@@ -0,0 +1,118 @@
+import argparse
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from app.services.orchestrator.memory import CHAT_MESSAGES_TABLE
+from app.utils.chat_history_cache import chat_history_cache
+from app.utils.supabase_pool import get_supabase_client
+
+load_dotenv()
+
+# explode the chats.messages arrays into one chat_messages row per message, keyed by (chat_id, seq)
+# rows are upserted on (chat_id, seq) so the tool can be run again (e.g. right before switching), the arrays are left untouched
+# once it has run, set CHAT_STORAGE=rows so ConversationManager reads and writes the rows
+#
+#   python -m app.services.orchestrator.migrate_chat_messages --print-schema
+#   python -m app.services.orchestrator.migrate_chat_messages --dry-run
+#   python -m app.services.orchestrator.migrate_chat_messages
+
+CHAT_MESSAGES_SCHEMA = f"""
+create table if not exists {CHAT_MESSAGES_TABLE} (
+    chat_id text not null,
+    seq integer not null,
+    id uuid not null default gen_random_uuid(),
+    role text not null,
+    content text,
+    "timestamp" timestamptz not null default now(),
+    primary key (chat_id, seq)
+);
+
+create unique index if not exists {CHAT_MESSAGES_TABLE}_id_idx on {CHAT_MESSAGES_TABLE} (id);
+create index if not exists {CHAT_MESSAGES_TABLE}_timestamp_idx on {CHAT_MESSAGES_TABLE} (chat_id, "timestamp");
+"""
+
+# chats read per request and rows written per upsert
+CHATS_PAGE_SIZE = 100
+ROWS_BATCH_SIZE = 500
+
+
+def explode_messages(chat_id: str, messages) -> list[dict]:
+    # a chat with a single message is stored as an object
+    if isinstance(messages, dict):
+        messages = [messages]
+
+    return [
+        {
+            "chat_id": chat_id,
+            "seq": seq,
+            # messages written before add_message gave them ids get one here
+            "id": message.get("id") or str(uuid4()),
+            "role": message.get("role"),
+            "content": message.get("content"),
+            "timestamp": message.get("timestamp"),
+        }
+        for seq, message in enumerate(messages or [])
+    ]
+
+
+def migrate_chat(client, chat_id: str, messages, dry_run: bool) -> int:
+    rows = explode_messages(chat_id, messages)
+
+    if dry_run:
+        return len(rows)
+
+    for i in range(0, len(rows), ROWS_BATCH_SIZE):
+        client.table(CHAT_MESSAGES_TABLE).upsert(rows[i:i + ROWS_BATCH_SIZE], on_conflict="chat_id,seq").execute()
+
+    # the cached history has the messages without their new ids
+    try:
+        chat_history_cache.invalidate(chat_id)
+    except Exception as e:
+        print(f"couldn't invalidate the cached history of {chat_id}: {e}")
+
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="move chat messages from the chats.messages arrays to chat_messages rows")
+    parser.add_argument("--chat-id", help="only migrate this chat")
+    parser.add_argument("--dry-run", action="store_true", help="count the rows without writing them")
+    parser.add_argument("--print-schema", action="store_true", help="print the sql for the chat_messages table and exit")
+    args = parser.parse_args()
+
+    if args.print_schema:
+        print(CHAT_MESSAGES_SCHEMA)
+        return
+
+    client = get_supabase_client()
+    page = 0
+    chats = 0
+    rows = 0
+
+    while True:
+        query = client.table("chats").select("chat_id, messages").order("chat_id")
+        if args.chat_id:
+            query = query.eq("chat_id", args.chat_id)
+
+        response = query.range(page * CHATS_PAGE_SIZE, (page + 1) * CHATS_PAGE_SIZE - 1).execute()
+
+        if not response.data:
+            break
+
+        for chat in response.data:
+            try:
+                count = migrate_chat(client, chat["chat_id"], chat["messages"], args.dry_run)
+            except Exception as e:
+                print(f"Error migrating chat {chat['chat_id']}: {e}")
+                continue
+
+            chats += 1
+            rows += count
+
+        page += 1
+
+    print(f"{'would migrate' if args.dry_run else 'migrated'} {rows} messages from {chats} chats")
+
+
+if __name__ == "__main__":
+    main()
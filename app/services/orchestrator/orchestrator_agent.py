@@ -1,11 +1,25 @@
+import asyncio
 import json
+import os
+import time
 from typing import Any, Dict, Optional
 from uuid import uuid4
 from app.services.agent_base import AgentBase
-from app.services.orchestrator.memory import ConversationManager
+from app.services.orchestrator.context_compactor import ContextCompactor
+from app.services.orchestrator.memory import ConversationManager, assistant_tool_call_record, flush_process_logs, process_log_message, usage_record
+from app.utils.communication_protocol import stream_frame
+
+# stream the final answer to the chat channel while it's being generated
+ORCHESTRATOR_STREAMING = os.getenv("ORCHESTRATOR_STREAMING", "true").lower() == "true"
+
+# how long a finished task waits for its process log steps to be written, they stay staged in redis if it runs out
+PROCESS_LOG_FLUSH_TIMEOUT = float(os.getenv("PROCESS_LOG_FLUSH_TIMEOUT", 5))
+
+# tools whose result can end the turn (a question for the user or a route to display)
+SHORT_CIRCUIT_TOOLS = {"user_interaction", "calculate_google_maps_route"}
 
 class OrchestratorAgent(AgentBase):
-    def __init__(self, name:str, client: Any, tool_definitions: list[Dict], tool_dict: Dict[str, callable], prompt: str, chat_id: str, user_id: str):
+    def __init__(self, name:str, client: Any, tool_definitions: list[Dict], tool_dict: Dict[str, callable], prompt: str, chat_id: str, user_id: str, publisher: Any = None, redis_client: Any = None):
         super().__init__( name=name, client=client)
 
         self.tools = tool_definitions
@@ -17,19 +31,41 @@ class OrchestratorAgent(AgentBase):
         self.task_id = None
         self.message_id = None
 
+        #async redis client used to stream the answer, no streaming without it
+        self.publisher = publisher if ORCHESTRATOR_STREAMING else None
+        self.stream_id = None
+
+        #the task's messages for the model, loaded once per task and appended to as the loop runs
+        self.messages = None
+        #process log writes run in the background one after the other, this is the last one
+        self.persist_task = None
+        #seq of this task's last buffered step, flush waits for it and not for other tasks' steps
+        self.last_log_seq = None
+
+        #keeps the prompt within the token budget, the running summaries are kept in redis
+        self.compactor = ContextCompactor(client, redis_client)
+
     #get message from redis broaker
-    def receive_message(self, packet):
+    #blocking supabase calls and tools run in the event loop's thread pool so one task doesn't stall the others
+    #entry_id is the task's stream entry, a redelivered entry doesn't log its message a second time
+    async def receive_message(self, packet, entry_id: str | None = None):
         print("message recieved...")
         #comes with task_id
         self.task_id = packet.get("task_id")
 
         #get message
         user_text = packet['content'].get("message")
-            
+
+        #the only time the process log is read, every step after this is appended in memory
+        self.messages, delivered = await asyncio.to_thread(self.memory.compile_process_logs, self.task_id, self.prompt)
+
+        if entry_id is not None and entry_id in delivered:
+            print(f"entry {entry_id} was delivered before, its message is already in the process log")
+
         #if there's no tool usage
-        if (packet.get("pending_tool_id") == None):
+        elif (packet.get("pending_tool_id") == None):
             # Log the user's start
-            self.memory.add_process_log(self.task_id, "user", user_text)
+            self._log("user", user_text)
 
             # if the message has lost coords
             if packet["content"].get("lost_coords") != None:
@@ -38,40 +74,134 @@ class OrchestratorAgent(AgentBase):
                 destination = packet['content'].get("destination")
 
                 # add lost coords to the lost coords database
-                self.memory.add_lost_coords(lost_coords, destination, self.user_id)
+                await asyncio.to_thread(self.memory.add_lost_coords, lost_coords, destination, self.user_id)
                 
         else:
             #get tool id
             tool_id = packet.get("pending_tool_id")
 
             #else add tool use to the process messages
-            self.memory.add_process_log(
-                task_id=self.task_id,
-                step_type="tool_result",
-                payload={
-                    "tool_call_id": tool_id, 
-                    "content": user_text
-                }
-            )
+            self._log("tool_result", {
+                "tool_call_id": tool_id, 
+                "content": user_text
+            })
+
+        #logged after the message so the marker is only there once the message is
+        if entry_id is not None and entry_id not in delivered:
+            self._log("delivery", {"entry_id": entry_id})
         
         # Start the Loop
-        return self.run()
+        #the caller publishes the result and then calls flush, the answer doesn't wait on the process log writes
+        try:
+            return await self.run()
+        finally:
+            if self.compactor.tokens_saved:
+                print(f"context compaction saved {self.compactor.tokens_saved} prompt tokens on task {self.task_id}")
+
+    #add a step to the in memory messages and persist it without waiting
+    def _log(self, step_type, payload):
+        message = process_log_message(step_type, payload)
+        if message is not None:
+            self.messages.append(message)
+
+        self.persist_task = asyncio.create_task(self._persist(self.persist_task, step_type, payload))
+
+    #writes are chained so the process log keeps the steps in order
+    async def _persist(self, previous, step_type, payload):
+        if previous is not None:
+            await previous
+
+        seq = await asyncio.to_thread(self.memory.add_process_log, self.task_id, step_type, payload)
+        if seq is not None:
+            self.last_log_seq = seq
+
+    #a resumed task has to find every step in the process log, returns False if they weren't all written in time
+    async def flush(self, timeout: float = PROCESS_LOG_FLUSH_TIMEOUT):
+        deadline = time.monotonic() + timeout
+
+        try:
+            if self.persist_task is not None:
+                await asyncio.wait_for(asyncio.shield(self.persist_task), timeout)
+
+            #the steps are buffered, the next worker to pick up the task reads them from the database
+            if self.last_log_seq is None:
+                written = True
+            else:
+                written = await asyncio.to_thread(flush_process_logs, max(0, deadline - time.monotonic()), self.last_log_seq)
+        except Exception as e:
+            print(f"Error writing the process log of task {self.task_id}: {e}")
+            written = False
+
+        if not written:
+            print(f"process log of task {self.task_id} not written after {timeout}s, left to the background writer")
+
+        return written
 
     #call LLM with parameters for differnet model (more or less thinking) and response format
-    def _LLM_call(self, model):
+    #client is an AsyncOpenAI client
+    async def _LLM_call(self, model):
 
         if not self.task_id:
             raise ValueError("No task_id set for LLM call")
-        
-        response = self.client.chat.completions.parse(
+
+        #self.messages stays exact, only what's sent is compacted
+        messages = await self.compactor.compact(self.task_id, list(self.messages))
+
+        started = time.monotonic()
+
+        if self.publisher is not None:
+            response = await self._LLM_stream(model, messages)
+        else:
+            response = await self.client.chat.completions.parse(
+                model=model,
+                messages=messages,
+                tools=self.tools,
+            )
+
+        self._log("usage", usage_record(response, time.monotonic() - started))
+
+        return response
+
+    #same call but the text is published to the chat channel as it comes in
+    #tool call turns usually have no text so nothing gets published for them
+    async def _LLM_stream(self, model, messages):
+        stream_id = str(uuid4())
+        streamed = False
+
+        async with self.client.chat.completions.stream(
             model=model,
-            messages=self.memory.compile_process_logs(self.task_id, self.prompt),
+            messages=messages,
             tools=self.tools,
-        )
+            #the usage only comes with the last chunk when it's asked for
+            stream_options={"include_usage": True},
+        ) as stream:
+            async for event in stream:
+                if event.type == "content.delta" and event.delta:
+                    await self._publish_frame(stream_id, "delta", {"delta": event.delta})
+                    streamed = True
 
-        return response
+            completion = await stream.get_final_completion()
+
+        if streamed:
+            message = completion.choices[0].message
+
+            #the text turned out to come with tool calls, tell the client to drop it
+            if message.tool_calls:
+                await self._publish_frame(stream_id, "cancel", {})
+            else:
+                await self._publish_frame(stream_id, "end", {"message": message.content})
+                self.stream_id = stream_id
+
+        return completion
+
+    async def _publish_frame(self, stream_id, event, content):
+        try:
+            await self.publisher.publish(self.chat_id, stream_frame(self.chat_id, self.name, stream_id, event, content, self.task_id))
+        except Exception as e:
+            # losing a frame only costs the live preview, the full answer still goes out at the end
+            print(f"Error publishing stream frame for {self.chat_id}: {e}")
     
-    def _use_tool(self, tool_call):
+    async def _use_tool(self, tool_call):
         func_name = tool_call.function.name
 
         #if the tool is in the agent's tool box
@@ -89,8 +219,8 @@ class OrchestratorAgent(AgentBase):
                     print("IN USER ID CONDITIONAL")
                     func_args["user_id"] = self.user_id
 
-                #use it
-                result = func(**func_args)
+                #use it, tools are blocking so they run in the thread pool
+                result = await asyncio.to_thread(func, **func_args)
                 print(f"func result for {func_name}")
                 print(result)
 
@@ -100,36 +230,49 @@ class OrchestratorAgent(AgentBase):
         else:
             return f"Error: Tool {func_name} not found."
 
-    
+    #run a completion's tool calls concurrently, turn latency is the slowest tool instead of the sum
+    #a batch ends at a tool that can end the turn, so nothing the model asked for after it runs unless the turn goes on
+    async def _use_tools(self, tool_calls):
+        results = []
+        start = 0
+
+        while start < len(tool_calls):
+            end = start
+            while end < len(tool_calls) - 1 and tool_calls[end].function.name not in SHORT_CIRCUIT_TOOLS:
+                end += 1
+
+            batch = tool_calls[start:end + 1]
+            results.extend(zip(batch, await asyncio.gather(*(self._use_tool(tool_call) for tool_call in batch))))
+
+            last = results[-1][1]
+            if isinstance(last, dict) and last.get('action') in ("ask_user", "display_route"):
+                break
+
+            start = end + 1
+
+        return results
+
         #run loop
-    def run(self):
+    async def run(self):
         #orchestrator loop to avoid countless conditional statements
         while True:
             print(f"{self.name} starting loop...")
             #model call
-            completion = self._LLM_call("gpt-5-nano")
-
-            #get model to decide if they want to use tool
-            completion.model_dump()
+            completion = await self._LLM_call("gpt-5-nano")
 
             #if we use tools, add the message to the message array 
             if completion.choices[0].message.tool_calls:
 
-                #add the tool usage to the process log
-                self.memory.add_process_log(
-                    task_id=self.task_id,
-                    step_type="assistant_tool_call", 
-                    payload=completion.model_dump() 
-                )
+                #add the tool usage to the process log, only the message is kept, the usage has its own record
+                self._log("assistant_tool_call", assistant_tool_call_record(completion))
 
-                #and loop to use tool(s)
-                for tool_call in completion.choices[0].message.tool_calls:
-                    result = self._use_tool(tool_call)
+                #and loop to use tool(s), the results come back in the order the model asked for them
+                for tool_call, result in await self._use_tools(completion.choices[0].message.tool_calls):
 
                     #check if the tool is a user question
                     if isinstance(result, dict) and result.get('action') == "ask_user":
                         #send the question to the front end
-                        self.memory.add_message(result['question'], "assistant")
+                        await asyncio.to_thread(self.memory.add_message, result['question'], "assistant")
 
                         user_reply = {
                             "performative": "REQUEST", 
@@ -151,14 +294,10 @@ class OrchestratorAgent(AgentBase):
                         # We need to inform the user AND send the polyline
                         print("in the route direction conditional")
                                                     
-                        self.memory.add_message(result['text'], "assistant")
+                        await asyncio.to_thread(self.memory.add_message, result['text'], "assistant")
                         
                         #save text to memory so LLM knows what happened
-                        self.memory.add_process_log(
-                            task_id=self.task_id,
-                            step_type="tool_result",
-                            payload={"tool_call_id": tool_call.id, "content": result['text']}
-                        )
+                        self._log("tool_result", {"tool_call_id": tool_call.id, "content": result['text']})
                         
                         #return the structured packet to the frontend
                         return {
@@ -174,14 +313,10 @@ class OrchestratorAgent(AgentBase):
                         }
 
                     #log the tool use         
-                    self.memory.add_process_log(
-                        task_id=self.task_id,
-                        step_type="tool_result",
-                        payload={
-                            "tool_call_id": tool_call.id, 
-                            "content": str(result)
-                        }
-                    )
+                    self._log("tool_result", {
+                        "tool_call_id": tool_call.id, 
+                        "content": str(result)
+                    })
             else:
                 # If no tools are called, return the models answer
                 final_content = completion.choices[0].message.content
@@ -189,7 +324,7 @@ class OrchestratorAgent(AgentBase):
                 print("final_content")
                 print(final_content)
                 
-                self.memory.add_message(final_content, "assistant")
+                await asyncio.to_thread(self.memory.add_message, final_content, "assistant")
                 
                 return {
                     "performative": "INFORM",
@@ -202,4 +337,7 @@ class OrchestratorAgent(AgentBase):
                     "task_id": self.task_id,
 
                     "content": {"message": final_content},
+
+                    #set when the answer was already streamed, so the client can replace the preview instead of adding it again
+                    "stream_id": self.stream_id,
                 }
\ No newline at end of file
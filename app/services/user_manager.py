@@ -1,42 +1,63 @@
-import os
 import time
 from typing import Optional
-from supabase import Client, create_client
+from supabase import Client
 from datetime import datetime, timezone
+from app.utils.supabase_pool import get_supabase_client
 
 class CredentialManager:
     def __init__(self):
-        self.url = os.environ.get("SUPABASE_URL")
-        self.key = os.environ.get("SUPABASE_API_KEY")
+        self.client: Client = get_supabase_client()
 
-        self.client: Client = create_client(self.url, self.key)
+    # change the expiry type to str to upload to db
+    def _format_expiry(self, expiry):
+        if type(expiry) == int:
+            print("expirty date converted to datetime str")
+            return time.strftime("%d %b %Y %H:%M:%S +0000", time.localtime(expiry))
+
+        elif type(expiry) == datetime:
+            print("expirty type is datetime")
+            print("datetime converted to str")
+            return expiry.strftime("%d %b %Y %H:%M:%S +0000")
+
+        return expiry
+
+    def _token_row(self, user_id, access_token, refresh_token, expiry):
+        return {
+            "user_id": user_id,
+            "google_access_token": access_token,
+            "google_refresh_token": refresh_token,
+            "expiry": self._format_expiry(expiry),
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }
 
     def add_google_tokens(self, user_id, access_token, refresh_token, expiry):
         try:
-            # change the expiry type to str to upload to db
-            if type(expiry) == int:
-                self.expiry_formatted = time.strftime("%d %b %Y %H:%M:%S +0000", time.localtime(expiry))
-                print("expirty date converted to datetime str")
-            
-            elif type(expiry) == datetime:
-                self.expiry_formatted = expiry.strftime("%d %b %Y %H:%M:%S +0000")
-                print("expirty type is datetime")
-                print("datetime converted to str")
-
             # if there's a user id, then add a credentials row for it
-            response = self.client.table("user_credentials").upsert({
-                "user_id": user_id,
-                "google_access_token": access_token,
-                "google_refresh_token": refresh_token,
-                "expiry": self.expiry_formatted,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }).execute()
+            response = self.client.table("user_credentials").upsert(
+                self._token_row(user_id, access_token, refresh_token, expiry)
+            ).execute()
 
             print("Successfully saved tokens")
             return response
         
         except Exception as e:
             return f"error adding user token to database: {e}"
+
+    # save several users' tokens in a single upsert, tokens is a list of dicts with the add_google_tokens arguments
+    def add_google_tokens_batch(self, tokens: list[dict]):
+        if not tokens:
+            return None
+
+        try:
+            response = self.client.table("user_credentials").upsert(
+                [self._token_row(**token) for token in tokens]
+            ).execute()
+
+            print(f"Successfully saved tokens for {len(tokens)} users")
+            return response
+
+        except Exception as e:
+            return f"error adding user tokens to database: {e}"
         
     def get_google_tokens(self, user_id):
         try:
@@ -47,4 +68,46 @@ class CredentialManager:
             return response.data
         
         except Exception as e:
-            return f"error adding user token to database: {e}"
\ No newline at end of file
+            return f"error adding user token to database: {e}"
+
+    # get the credentials that expire before a given time so they can be refreshed ahead of use
+    # tokens that expired before expires_after are left out, long dead or revoked ones would sort first and fill every batch
+    def get_expiring_google_tokens(self, expires_before: datetime, limit: int = 100, expires_after: datetime | None = None):
+        try:
+            query = (
+                self.client.table("user_credentials")
+                .select("user_id, google_access_token, google_refresh_token, expiry")
+                .lt("expiry", expires_before.isoformat())
+            )
+
+            if expires_after is not None:
+                query = query.gt("expiry", expires_after.isoformat())
+
+            response = (
+                query
+                .order("expiry", desc=False)
+                .limit(limit)
+                .execute()
+            )
+            return response.data if response.data else []
+
+        except Exception as e:
+            print(f"error getting expiring tokens: {e}")
+            return []
+
+    # last gmail historyId we processed for the user, used for incremental syncs
+    def get_gmail_history_id(self, user_id):
+        try:
+            response = self.client.table("users").select("gmail_history_id").eq("id", user_id).single().execute()
+            return response.data.get("gmail_history_id") if response.data else None
+
+        except Exception as e:
+            print(f"error getting gmail history id: {e}")
+            return None
+
+    def set_gmail_history_id(self, user_id, history_id):
+        try:
+            return self.client.table("users").update({"gmail_history_id": str(history_id)}).eq("id", user_id).execute()
+
+        except Exception as e:
+            print(f"error saving gmail history id: {e}")
@@ -0,0 +1,204 @@
+from datetime import datetime, timezone
+import json
+import os
+import redis
+
+# KEYS: history list, existence flag, version, timestamp index, message id index, pending writes
+# a message's position in the history list is its sequence number in the chat, the two indexes
+# map timestamps (zset scores) and message ids (hash) to positions so pages can be read with LRANGE
+
+# a write bumps the version and appends to the cached history if there is one (or the chat is known to be empty)
+_APPEND = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('GET', KEYS[2]) == '0' then
+    local position = redis.call('RPUSH', KEYS[1], ARGV[1]) - 1
+    redis.call('ZADD', KEYS[4], ARGV[3], position)
+    if ARGV[4] ~= '' then
+        redis.call('HSET', KEYS[5], ARGV[4], position)
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[4], ARGV[2])
+    redis.call('EXPIRE', KEYS[5], ARGV[2])
+end
+redis.call('SET', KEYS[2], '1', 'EX', ARGV[2])
+"""
+
+# only cache what we loaded if nobody wrote to the chat while we were loading it
+# ARGV after the first three is (message, timestamp, id) triples
+_FILL = """
+local version = redis.call('GET', KEYS[3]) or '0'
+if version ~= ARGV[1] then
+    return 0
+end
+-- messages still waiting in a write behind buffer aren't in what we loaded
+if tonumber(redis.call('GET', KEYS[6]) or '0') > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[4], KEYS[5])
+-- one push per message, unpack would hit lua's stack limit on long chats
+for i = 4, #ARGV, 3 do
+    local position = redis.call('RPUSH', KEYS[1], ARGV[i]) - 1
+    redis.call('ZADD', KEYS[4], ARGV[i + 1], position)
+    if ARGV[i + 2] ~= '' then
+        redis.call('HSET', KEYS[5], ARGV[i + 2], position)
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[4], ARGV[2])
+redis.call('EXPIRE', KEYS[5], ARGV[2])
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[2])
+return 1
+"""
+
+
+# iso timestamps, naive ones are utc like the ones add_message writes
+def parse_timestamp(value: str) -> float:
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+
+    return date.timestamp()
+
+
+# seconds a pending write blocks caching a chat's history if it's never written
+PENDING_WRITES_TTL = 10 * 60
+
+
+def _timestamp_score(message: dict) -> float:
+    try:
+        return parse_timestamp(message["timestamp"])
+    except Exception:
+        return 0
+
+
+# write-through cache of the chats.messages column, one redis list per chat
+# plus an existence flag so writes don't have to download the history to know if the chat exists
+class ChatHistoryCache:
+    def __init__(self, redis_client: redis.Redis, ttl: int | None = None):
+        self.r = redis_client
+
+        # idle chats drop out of the cache, the next read loads them from supabase again
+        self.ttl = ttl or int(os.getenv("CHAT_HISTORY_CACHE_TTL", 24 * 60 * 60))
+
+        self.append_script = self.r.register_script(_APPEND)
+        self.fill_script = self.r.register_script(_FILL)
+
+    def _keys(self, chat_id: str):
+        return [
+            f"chat_history:{chat_id}",
+            f"chat_exists:{chat_id}",
+            f"chat_history_version:{chat_id}",
+            f"chat_history_timestamps:{chat_id}",
+            f"chat_history_ids:{chat_id}",
+            f"chat_history_pending:{chat_id}",
+        ]
+
+    # the cached history, None if it isn't cached
+    def get(self, chat_id: str) -> list | None:
+        history_key, exists_key, *_ = self._keys(chat_id)
+
+        pipe = self.r.pipeline()
+        pipe.get(exists_key)
+        pipe.lrange(history_key, 0, -1)
+        exists, messages = pipe.execute()
+
+        if exists is None:
+            return None
+
+        # an empty list isn't stored, the flag tells us the chat has no messages
+        if not messages and exists == b"1":
+            return None
+
+        return [json.loads(message) for message in messages]
+
+    # (message count, last message) without reading the history, None if it isn't cached
+    def stat(self, chat_id: str) -> tuple[int, dict | None] | None:
+        history_key, exists_key, *_ = self._keys(chat_id)
+
+        pipe = self.r.pipeline()
+        pipe.get(exists_key)
+        pipe.llen(history_key)
+        pipe.lindex(history_key, -1)
+        exists, count, last = pipe.execute()
+
+        if exists is None or (exists == b"1" and count == 0):
+            return None
+
+        return count, json.loads(last) if last else None
+
+    # messages start..end (inclusive) in chat order, each with its position as "seq"
+    def range(self, chat_id: str, start: int, end: int) -> list[dict]:
+        messages = self.r.lrange(self._keys(chat_id)[0], start, end)
+
+        return [{**json.loads(message), "seq": start + i} for i, message in enumerate(messages)]
+
+    # position of the first message after the given message id or iso timestamp, None if the id isn't known
+    def position_after(self, chat_id: str, since: str) -> int | None:
+        *_, timestamps_key, ids_key, _ = self._keys(chat_id)
+
+        try:
+            score = parse_timestamp(since)
+        except ValueError:
+            position = self.r.hget(ids_key, since)
+            return int(position) + 1 if position is not None else None
+
+        first = self.r.zrangebyscore(timestamps_key, f"({score}", "+inf", start=0, num=1)
+        if first:
+            return int(first[0])
+
+        return self.r.llen(self._keys(chat_id)[0])
+
+    # True / False if we know whether the chat exists, None if we don't
+    def exists(self, chat_id: str) -> bool | None:
+        flag = self.r.get(self._keys(chat_id)[1])
+
+        return None if flag is None else flag == b"1"
+
+    # read before loading from supabase and pass to fill
+    def version(self, chat_id: str) -> bytes:
+        return self.r.get(self._keys(chat_id)[2]) or b"0"
+
+    def fill(self, chat_id: str, messages: list, version: bytes) -> bool:
+        args = [version, self.ttl, "1" if messages else "0"]
+        for message in messages:
+            args.extend([json.dumps(message), _timestamp_score(message), message.get("id", "")])
+
+        return bool(self.fill_script(keys=self._keys(chat_id), args=args))
+
+    def append(self, chat_id: str, message: dict):
+        self.append_script(
+            keys=self._keys(chat_id),
+            args=[json.dumps(message), self.ttl, _timestamp_score(message), message.get("id", "")]
+        )
+
+    # count messages that are added to the cache before they reach the database
+    # the expiry is a backstop in case the process holding them dies before writing them
+    def add_pending(self, chat_id: str, count: int = 1):
+        pending_key = self._keys(chat_id)[5]
+
+        pipe = self.r.pipeline()
+        pipe.incrby(pending_key, count)
+        pipe.expire(pending_key, PENDING_WRITES_TTL)
+        pipe.execute()
+
+    def remove_pending(self, chat_id: str, count: int = 1):
+        pending_key = self._keys(chat_id)[5]
+
+        # the key expired while the writes were pending, don't let it go negative
+        if self.r.decrby(pending_key, count) <= 0:
+            self.r.delete(pending_key)
+
+    # drop the cached history, e.g. after a failed write
+    def invalidate(self, chat_id: str):
+        history_key, exists_key, version_key, timestamps_key, ids_key, _ = self._keys(chat_id)
+
+        pipe = self.r.pipeline()
+        pipe.delete(history_key, exists_key, timestamps_key, ids_key)
+        pipe.incr(version_key)
+        pipe.expire(version_key, self.ttl)
+        pipe.execute()
+
+
+chat_history_cache = ChatHistoryCache(redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=6379, db=0))
@@ -1,3 +1,4 @@
+import json
 from typing import Any, Dict, Optional
 from pydantic import BaseModel
 
@@ -14,4 +15,18 @@ class AgentMessage(BaseModel):
     task_id: Optional[str] = None
 
     #actual message sent
-    content: Dict[str, Any]
\ No newline at end of file
+    content: Dict[str, Any]
+
+#frames used to stream a reply to the chat while it's being generated
+#"delta" frames carry the new text, the "end" frame carries the full text once generation is done
+def stream_frame(chat_id: str, sender: str, stream_id: str, event: str, content: Dict[str, Any], task_id: Optional[str] = None) -> str:
+    return json.dumps({
+        "performative": "STREAM",
+        "event": event,
+        "stream_id": stream_id,
+        "chat_id": chat_id,
+        "sender": sender,
+        "receiver": "USER",
+        "task_id": task_id,
+        "content": content,
+    })
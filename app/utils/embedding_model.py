@@ -0,0 +1,19 @@
+import threading
+from sentence_transformers import SentenceTransformer
+
+EMBEDDING_MODEL_NAME = "Supabase/gte-small"
+
+_model = None
+_model_lock = threading.Lock()
+
+
+# the model is loaded once per process and shared by the email embedder and the intent classifier
+def get_embedding_model() -> SentenceTransformer:
+    global _model
+
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+    return _model
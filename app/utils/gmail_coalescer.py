@@ -0,0 +1,105 @@
+import os
+import time
+import redis
+
+# keep the highest history id of the burst, history ids are numeric strings
+_SET_MAX_HISTORY_ID = """
+local current = redis.call('GET', KEYS[1])
+if (not current) or (tonumber(ARGV[1]) > tonumber(current)) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+# release the run flag only if nothing new arrived while we were running
+_RELEASE_IF_IDLE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+return 1
+"""
+
+
+class GmailNotificationCoalescer:
+    def __init__(self, redis_client: redis.Redis, debounce: float | None = None, max_wait: float | None = None):
+        self.r = redis_client
+
+        # wait for the inbox to be quiet for debounce seconds, but never more than max_wait from the first notification
+        self.debounce = debounce or float(os.getenv("GMAIL_DEBOUNCE_SECONDS", 5))
+        self.max_wait = max_wait or float(os.getenv("GMAIL_MAX_WAIT_SECONDS", 30))
+
+        # the run flag expires in case the process running it dies, the worker refreshes it while it runs
+        self.flag_ttl = int(self.max_wait * 10)
+
+        self.set_max_history_id = self.r.register_script(_SET_MAX_HISTORY_ID)
+        self.release_if_idle = self.r.register_script(_RELEASE_IF_IDLE)
+
+    def _keys(self, email: str):
+        return {
+            "history": f"gmail_pending:{email}:history_id",
+            "first": f"gmail_pending:{email}:first",
+            "last": f"gmail_pending:{email}:last",
+            "scheduled": f"gmail_pending:{email}:scheduled",
+        }
+
+    # record a notification, returns True if the caller has to schedule a run for this user
+    def notify(self, email: str, history_id) -> bool:
+        keys = self._keys(email)
+        now = time.time()
+
+        pipe = self.r.pipeline()
+        if history_id:
+            self.set_max_history_id(keys=[keys["history"]], args=[str(history_id)], client=pipe)
+        else:
+            pipe.setnx(keys["history"], 0)
+        pipe.set(keys["first"], now, nx=True)
+        pipe.set(keys["last"], now)
+        pipe.execute()
+
+        return bool(self.r.set(keys["scheduled"], now, nx=True, ex=self.flag_ttl))
+
+    # the run couldn't be scheduled (e.g. the queue is full), the next notification has to schedule it
+    def cancel(self, email: str):
+        self.r.delete(self._keys(email)["scheduled"])
+
+    # keep the run flag while a long ingestion is running so a second run of the mailbox can't start
+    def refresh(self, email: str):
+        self.r.expire(self._keys(email)["scheduled"], self.flag_ttl)
+
+    # seconds until the user's burst is over, 0 if we can run now
+    def seconds_until_ready(self, email: str) -> float:
+        keys = self._keys(email)
+        now = time.time()
+
+        first, last = self.r.mget(keys["first"], keys["last"])
+
+        # nothing pending
+        if first is None or last is None:
+            return 0
+
+        first, last = float(first), float(last)
+
+        if now - last >= self.debounce or now - first >= self.max_wait:
+            return 0
+
+        return min(self.debounce - (now - last), self.max_wait - (now - first))
+
+    # take everything pending for the user, the next notification starts a new burst
+    def take(self, email: str):
+        keys = self._keys(email)
+
+        pipe = self.r.pipeline()
+        pipe.get(keys["history"])
+        pipe.delete(keys["history"], keys["first"], keys["last"])
+        history_id, _ = pipe.execute()
+
+        if history_id is None or history_id == b"0":
+            return None
+
+        return history_id.decode("utf-8")
+
+    # call after the run, returns False if notifications came in while we were running and we need another pass
+    def release(self, email: str) -> bool:
+        keys = self._keys(email)
+
+        return bool(self.release_if_idle(keys=[keys["history"], keys["scheduled"]]))
@@ -1,13 +1,12 @@
 import base64
 from http import client
 import json
-import os
 
 from openai import OpenAI
-from supabase import create_client
 from app.services.data_interpreter.data_interpreter import CalendarEventManager, EmailIngestionPipeline
 from app.services.google_services.gmail_service.gmail_client import GmailClient
 from app.services.google_services.google_service_builder import GoogleServiceBuilder
+from app.utils.supabase_pool import get_supabase_client
 
 
 def trigger_gmail_watch_service(credential_manager, user_id):
@@ -25,23 +24,27 @@ def trigger_gmail_watch_service(credential_manager, user_id):
 
     gmail_client = GmailClient(user_id=user_id, credential_manager=credential_manager, scopes=scopes, service=gmail_service)
 
-    gmail_client.watch_inbox()
+    watch_response = gmail_client.watch_inbox()
 
+    # start incremental syncs from the moment the watch was set up
+    if watch_response and watch_response.get("historyId"):
+        credential_manager.set_gmail_history_id(user_id, watch_response.get("historyId"))
 
-def execute_gmail_task(data):
-    client = OpenAI()
 
-    # decode data
+# pub/sub data is the base64 encoded email address and the mailbox's history id
+def decode_gmail_notification(data):
     data_decoded = base64.b64decode(data).decode("utf-8")
-    # get email from data
-    email = json.loads(data_decoded).get("emailAddress")
+    notification = json.loads(data_decoded)
+
+    return notification.get("emailAddress"), notification.get("historyId")
+
+
+def run_gmail_ingestion(email, history_id):
+    client = OpenAI()
 
     print(email)
     
-    supabase = create_client(
-        os.environ.get("SUPABASE_URL"),
-        os.environ.get("SUPABASE_API_KEY")
-    )
+    supabase = get_supabase_client()
     
     # get user_id from supabase 
     try:
@@ -58,7 +61,7 @@ def execute_gmail_task(data):
     calendar_processor = CalendarEventManager(user_id)
 
     #process data
-    appointments = email_processor.run()
+    appointments = email_processor.run(history_id=history_id)
 
     print("appointments")
     print(appointments)
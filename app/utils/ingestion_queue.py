@@ -0,0 +1,43 @@
+import os
+import time
+import redis
+
+
+class IngestionQueueFull(Exception):
+    pass
+
+
+# sorted set of mailboxes waiting for ingestion, scored by the time they're ready to run
+# a mailbox is only ever in the queue once, so a busy inbox can't starve the others
+class IngestionQueue:
+    def __init__(self, redis_client: redis.Redis, name: str = "ingestion_queue", max_depth: int | None = None):
+        self.r = redis_client
+        self.name = name
+        self.max_depth = max_depth or int(os.getenv("INGESTION_MAX_QUEUE_DEPTH", 1000))
+
+    def depth(self) -> int:
+        return self.r.zcard(self.name)
+
+    def is_full(self) -> bool:
+        return self.depth() >= self.max_depth
+
+    def enqueue(self, email: str, delay: float = 0) -> bool:
+        if self.is_full() and self.r.zscore(self.name, email) is None:
+            raise IngestionQueueFull(f"{self.name} has {self.max_depth} mailboxes waiting")
+
+        return bool(self.r.zadd(self.name, {email: time.time() + delay}, nx=True))
+
+    # put a claimed mailbox back, ignores the depth bound since it already had a place in the queue
+    def requeue(self, email: str, delay: float = 0) -> None:
+        self.r.zadd(self.name, {email: time.time() + delay})
+
+    # claim the mailbox that has been ready the longest, None if nothing is ready
+    def claim(self):
+        ready = self.r.zrangebyscore(self.name, "-inf", time.time(), start=0, num=1)
+
+        for email in ready:
+            # zrem is atomic so only one worker gets the mailbox
+            if self.r.zrem(self.name, email):
+                return email.decode("utf-8")
+
+        return None
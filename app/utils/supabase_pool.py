@@ -0,0 +1,58 @@
+import os
+import threading
+import httpx
+from supabase import Client, ClientOptions, create_client
+
+# one supabase client per process, shared by every manager class so we keep
+# the same keep-alive connections instead of doing a TLS handshake per object
+
+_client: Client | None = None
+
+_client_lock = threading.Lock()
+
+
+#pool size and timeouts are read lazily so load_dotenv() has run by the time we need them
+def _get_limits() -> httpx.Limits:
+    pool_size = int(os.getenv("SUPABASE_POOL_SIZE", 20))
+
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", 30)),
+    )
+
+
+def _get_timeout() -> httpx.Timeout:
+    # per call timeouts, the postgrest client takes them from the shared http client
+    return httpx.Timeout(
+        float(os.getenv("SUPABASE_TIMEOUT", 10)),
+        connect=float(os.getenv("SUPABASE_CONNECT_TIMEOUT", 5)),
+        pool=float(os.getenv("SUPABASE_POOL_TIMEOUT", 5)),
+    )
+
+
+def get_supabase_client() -> Client:
+    global _client
+
+    if _client is None:
+        # double checked so threads from the fastapi threadpool don't build two clients
+        with _client_lock:
+            if _client is None:
+                http_client = httpx.Client(limits=_get_limits(), timeout=_get_timeout(), http2=True)
+
+                _client = create_client(
+                    os.environ.get("SUPABASE_URL"),
+                    os.environ.get("SUPABASE_API_KEY"),
+                    options=ClientOptions(httpx_client=http_client),
+                )
+
+    return _client
+
+
+#close the pooled connections on shutdown
+async def close_supabase_clients() -> None:
+    global _client
+
+    if _client is not None:
+        _client.postgrest.session.close()
+        _client = None
@@ -0,0 +1,167 @@
+import json
+import os
+import socket
+import redis
+import redis.asyncio as aioredis
+
+# orchestrator tasks go through a redis stream read by a consumer group, so every orchestrator
+# replica shares the work and a task stays pending until the worker that ran it acks it
+ORCHESTRATOR_STREAM = "orchestrator_stream"
+ORCHESTRATOR_GROUP = "orchestrators"
+
+# tasks that failed max_deliveries times end up here for inspection
+ORCHESTRATOR_DEAD_LETTER_STREAM = "orchestrator_dead_letter"
+
+# every task gets the next sequence number of its chat, and a chat's tasks run in sequence order
+# the done key holds the highest sequence number of the chat that has finished
+CHAT_SEQ_KEY = "orchestrator_chat_seq:{chat_id}"
+CHAT_DONE_KEY = "orchestrator_chat_done:{chat_id}"
+
+# both keys expire together once the chat has been idle for a while
+CHAT_ORDER_TTL = 7 * 24 * 60 * 60
+
+# number the task and add it in one step so the stream order matches the sequence order
+_DISPATCH = """
+local seq = redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return redis.call('XADD', KEYS[1], '*', 'data', ARGV[1], 'chat_id', ARGV[2], 'seq', seq)
+"""
+
+_MARK_DONE = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+"""
+
+
+#works with both clients, with an async redis client the result has to be awaited
+#the calendar manager uses a sync client, the api and client agent an async one
+def dispatch_orchestrator_task(r: redis.Redis | aioredis.Redis, data: str):
+    chat_id = json.loads(data).get("chat_id")
+
+    return r.eval(
+        _DISPATCH, 2,
+        ORCHESTRATOR_STREAM, CHAT_SEQ_KEY.format(chat_id=chat_id),
+        data, chat_id, CHAT_ORDER_TTL
+    )
+
+
+class OrchestratorStreamConsumer:
+    def __init__(self, r: aioredis.Redis, consumer_name: str | None = None):
+        self.r = r
+        self.stream = ORCHESTRATOR_STREAM
+        self.group = ORCHESTRATOR_GROUP
+        self.dead_letter_stream = ORCHESTRATOR_DEAD_LETTER_STREAM
+        self.consumer_name = consumer_name or f"{socket.gethostname()}-{os.getpid()}"
+
+        # a task nobody has touched for this long is assumed lost and claimed by another worker
+        self.visibility_timeout = int(os.getenv("ORCHESTRATOR_VISIBILITY_TIMEOUT_MS", 120000))
+        self.max_deliveries = int(os.getenv("ORCHESTRATOR_MAX_DELIVERIES", 3))
+
+        self.mark_done_script = self.r.register_script(_MARK_DONE)
+
+    async def setup(self):
+        try:
+            await self.r.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            # the group already exists
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _delivery_count(self, entry_id) -> int:
+        pending = await self.r.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+        return pending[0]["times_delivered"] if pending else 0
+
+    async def _dead_letter(self, entry_id, fields):
+        print(f"moving task {entry_id} to {self.dead_letter_stream}")
+
+        pipe = self.r.pipeline()
+        pipe.xadd(self.dead_letter_stream, {**fields, b"entry_id": entry_id})
+        pipe.xack(self.stream, self.group, entry_id)
+        pipe.xdel(self.stream, entry_id)
+        await pipe.execute()
+
+        # the chat's next tasks shouldn't wait for a task that will never run
+        await self.mark_done(*self._order(fields))
+
+    # dead letter a task that can never run (e.g. it isn't valid json) without waiting for its retries
+    async def reject(self, entry_id, raw_data, chat_id: str | None = None, seq: int | None = None):
+        fields = {b"data": raw_data}
+        if chat_id is not None:
+            fields[b"chat_id"] = chat_id.encode("utf-8")
+        if seq is not None:
+            fields[b"seq"] = str(seq).encode("utf-8")
+
+        await self._dead_letter(entry_id, fields)
+
+    def _order(self, fields):
+        chat_id = fields.get(b"chat_id")
+        seq = fields.get(b"seq")
+
+        return (chat_id.decode("utf-8") if chat_id else None, int(seq) if seq else None)
+
+    # claim one task that another (probably dead) worker left pending for longer than the visibility timeout
+    async def _claim_stuck(self):
+        _, entries, _ = await self.r.xautoclaim(
+            self.stream, self.group, self.consumer_name,
+            min_idle_time=self.visibility_timeout, count=1
+        )
+
+        for entry_id, fields in entries:
+            if await self._delivery_count(entry_id) > self.max_deliveries:
+                await self._dead_letter(entry_id, fields)
+                continue
+
+            return entry_id, fields
+
+        return None
+
+    # get the next task as (entry_id, data, chat_id, seq), None if nothing arrived within block_ms
+    async def read(self, block_ms: int = 1000):
+        claimed = await self._claim_stuck()
+
+        if claimed is None:
+            response = await self.r.xreadgroup(
+                self.group, self.consumer_name, {self.stream: ">"}, count=1, block=block_ms
+            )
+
+            if not response:
+                return None
+
+            _, entries = response[0]
+            claimed = entries[0]
+
+        entry_id, fields = claimed
+        return (entry_id, fields[b"data"], *self._order(fields))
+
+    # keep a long running task from looking stuck, justid doesn't bump the delivery count
+    async def heartbeat(self, entry_id):
+        await self.r.xclaim(
+            self.stream, self.group, self.consumer_name,
+            min_idle_time=0, message_ids=[entry_id], justid=True
+        )
+
+    async def ack(self, entry_id, chat_id: str | None = None, seq: int | None = None):
+        pipe = self.r.pipeline()
+        pipe.xack(self.stream, self.group, entry_id)
+        pipe.xdel(self.stream, entry_id)
+        await pipe.execute()
+
+        await self.mark_done(chat_id, seq)
+
+    async def mark_done(self, chat_id: str | None, seq: int | None):
+        if chat_id is None or seq is None:
+            return
+
+        await self.mark_done_script(keys=[CHAT_DONE_KEY.format(chat_id=chat_id)], args=[seq, CHAT_ORDER_TTL])
+
+    # a task can run once every earlier task of its chat has finished
+    async def is_turn(self, chat_id: str | None, seq: int | None) -> bool:
+        if chat_id is None or seq is None:
+            return True
+
+        done = await self.r.get(CHAT_DONE_KEY.format(chat_id=chat_id))
+
+        return int(done or 0) >= seq - 1
@@ -1,43 +1,197 @@
+from collections import deque
 import os
-from typing import Any, Dict
+from typing import Any, Awaitable, Callable, Dict
 import asyncio
 import redis.asyncio as aioredis
 import json
 from fastapi import WebSocket
 
+# one redis pub/sub connection per process, channels are subscribed and unsubscribed as chats come and go
+# and a single reader task hands every message to on_message
 class RedisPubSubManager:
-    def __init__(self, host: str = os.getenv("REDIS_HOST", "localhost"), port: int = 6379):
+    def __init__(self, on_message: Callable[[str, str], Awaitable[None]], host: str = os.getenv("REDIS_HOST", "localhost"), port: int = 6379):
         self.host = host
         self.port = port
+        self.on_message = on_message
         self.pubsub = None
         self.redis_connection = None
+        self.reader_task = None
+
+        # channel -> number of local subscribers, we only talk to redis on the first and last one
+        self.channel_counts: Dict[str, int] = {}
+        self.lock = asyncio.Lock()
+        self.has_subscriptions = asyncio.Event()
 
     async def _get_redis_connection(self) -> aioredis.Redis:
         return aioredis.Redis(host=self.host, port=self.port,auto_close_connection_pool=False)
-    
-    #connect and initiate redis pubsub
+
+    #connect and initiate redis pubsub, only the first call does anything
     async def connect(self) -> None:
+        if self.redis_connection is not None:
+            return
+
         self.redis_connection = await self._get_redis_connection()
-        self.pubsub = self.redis_connection.pubsub()
+        self.pubsub = self.redis_connection.pubsub(ignore_subscribe_messages=True)
+        self.reader_task = asyncio.create_task(self._pubsub_data_reader())
+
+    async def publish(self, channel: str, message: str):
+        await self.connect()
+        return await self.redis_connection.publish(channel, message)
 
-    async def _publish(self, channel: str, message: str):
-        return self.redis_connection.publish(channel, message)
-    
-    async def subscribe(self, channel: str) -> aioredis.Redis:
-        await self.pubsub.subscribe(channel)
-        return self.pubsub
+    async def subscribe(self, channel: str) -> None:
+        await self.connect()
+
+        async with self.lock:
+            self.channel_counts[channel] = self.channel_counts.get(channel, 0) + 1
+
+            if self.channel_counts[channel] == 1:
+                await self.pubsub.subscribe(channel)
+                self.has_subscriptions.set()
 
     async def unsubscribe(self, channel: str) -> None:
-        await self.pubsub.unsubscribe(channel)
+        async with self.lock:
+            if channel not in self.channel_counts:
+                return
+
+            self.channel_counts[channel] -= 1
+
+            if self.channel_counts[channel] == 0:
+                del self.channel_counts[channel]
+                await self.pubsub.unsubscribe(channel)
+
+    # blocks on the connection instead of polling, so an idle process doesn't use any cpu
+    async def _pubsub_data_reader(self):
+        while True:
+            try:
+                # listen() returns when there are no channels left, wait for the next subscription
+                await self.has_subscriptions.wait()
+
+                async for message in self.pubsub.listen():
+                    if message is None or message["type"] != "message":
+                        continue
+
+                    chat_id = message['channel'].decode('utf-8')
+                    data = message['data'].decode('utf-8')
+
+                    try:
+                        await self.on_message(chat_id, data)
+                    except Exception as e:
+                        print(f"Error dispatching pubsub message for {chat_id}: {e}")
+
+                if not self.pubsub.subscribed:
+                    self.has_subscriptions.clear()
+
+            except asyncio.CancelledError:
+                # Handle clean exit when we cancel the task
+                raise
+            except Exception as e:
+                # the pubsub resubscribes to its channels when it reconnects
+                print(f"pubsub reader error: {e}")
+                await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        if self.reader_task:
+            self.reader_task.cancel()
+            self.reader_task = None
+
+        if self.pubsub:
+            await self.pubsub.aclose()
+            self.pubsub = None
+
+        if self.redis_connection:
+            await self.redis_connection.aclose()
+            self.redis_connection = None
+
+
+# what to do with a new frame when a socket's queue is full
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+# replace the newest queued frame, for frames that supersede each other
+OVERFLOW_COALESCE = "coalesce"
+# the client can't keep up, close it so it reconnects and refetches the history
+OVERFLOW_DISCONNECT = "disconnect"
+
+
+# every socket gets a bounded outbound queue drained by its own writer task,
+# so a slow client only ever delays its own frames
+class SocketSender:
+    def __init__(self, websocket: WebSocket, max_queue: int, overflow_policy: str):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped_frames = 0
 
+        self.writer_task = asyncio.create_task(self._writer())
 
+    def depth(self) -> int:
+        return len(self.queue)
+
+    # never waits, the producer only appends to the queue
+    def send(self, message: str) -> None:
+        if self.closed:
+            return
+
+        if len(self.queue) >= self.max_queue:
+            self.dropped_frames += 1
+
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                print("websocket send queue full, disconnecting slow client")
+                asyncio.create_task(self.close(code=1013))
+                return
+
+            if self.overflow_policy == OVERFLOW_COALESCE:
+                self.queue[-1] = message
+                return
+
+            self.queue.popleft()
+
+        self.queue.append(message)
+        self.ready.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+
+                while self.queue:
+                    await self.websocket.send_text(self.queue.popleft())
+
+                self.ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # the socket is gone, the endpoint's receive loop will clean it up
+            print(f"websocket writer stopped: {e}")
+            self.closed = True
+
+    async def close(self, code: int = 1000) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+        self.writer_task.cancel()
+
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
 
 
 class WebsocketManager:
     def __init__(self):
         self.active_connections: Dict = {}
-        self.pubsub_client = RedisPubSubManager()
-        self.tasks = {}
+        self.pubsub_client = RedisPubSubManager(on_message=self._broadcast)
+
+        # websocket -> SocketSender
+        self.senders: Dict[WebSocket, SocketSender] = {}
+        self.max_queue = int(os.getenv("WS_SEND_QUEUE_SIZE", 100))
+        self.overflow_policy = os.getenv("WS_OVERFLOW_POLICY", OVERFLOW_DROP_OLDEST)
+
+        # frames dropped by sockets that already disconnected
+        self.dropped_frames = 0
 
 
     async def connect(self, chat_id:str, websocket: WebSocket) -> None:
@@ -47,12 +201,10 @@ class WebsocketManager:
         if chat_id not in self.active_connections:
             self.active_connections[chat_id] = []
 
-            await self.pubsub_client.connect()
-            pubsub_subscriber = await self.pubsub_client.subscribe(chat_id)
-            task = asyncio.create_task(self._pubsub_data_reader(pubsub_subscriber))
-            self.tasks[chat_id] = task
-            
         self.active_connections[chat_id].append(websocket)
+        self.senders[websocket] = SocketSender(websocket, self.max_queue, self.overflow_policy)
+
+        await self.pubsub_client.subscribe(chat_id)
 
 
     async def disconnect(self, chat_id:str, websocket):
@@ -60,36 +212,45 @@ class WebsocketManager:
         if chat_id in self.active_connections:
             if websocket in self.active_connections[chat_id]:
                 self.active_connections[chat_id].remove(websocket)
+                await self.pubsub_client.unsubscribe(channel=chat_id)
+
+                sender = self.senders.pop(websocket, None)
+                if sender:
+                    self.dropped_frames += sender.dropped_frames
+                    sender.closed = True
+                    sender.writer_task.cancel()
 
             if len(self.active_connections[chat_id]) == 0:
                 del self.active_connections[chat_id]
-                await self.pubsub_client.unsubscribe(channel=chat_id)
-
-                if chat_id in self.tasks:
-                    self.tasks[chat_id].cancel()
-                    del self.tasks[chat_id]
 
+    # only reaches the sockets connected to this process
     async def send_message(self, chat_id, message):
+        await self._broadcast(chat_id, message)
+
+    # reaches the chat's sockets on every api process, each one gets it back through its pubsub reader
+    async def publish(self, chat_id, message):
+        await self.pubsub_client.publish(chat_id, message)
+
+    # queue a message for every socket of the chat connected to this process
+    async def _broadcast(self, chat_id, message):
         # find the socket for the chat id
         if chat_id in self.active_connections:
             for socket in self.active_connections[chat_id]:
                 #send the message
-                await socket.send_text(message)
+                self.senders[socket].send(message)
 
-    async def _pubsub_data_reader(self, pubsub_subscriber):
-            try:
-                while True:
-                    message = await pubsub_subscriber.get_message(ignore_subscribe_messages=True)
-                    if message is not None:
-                        chat_id = message['channel'].decode('utf-8')
-                        if chat_id in self.active_connections:
-                            data = message['data'].decode('utf-8')
-                            for socket in self.active_connections[chat_id]:
-                                await socket.send_text(data)
-                    # Small sleep to prevent CPU spiking
-                    await asyncio.sleep(0.01) 
-            except asyncio.CancelledError:
-                # Handle clean exit when we cancel the task
-                pass
+    # queue depth and dropped frames across this process's sockets
+    def metrics(self) -> Dict[str, Any]:
+        depths = [sender.depth() for sender in self.senders.values()]
+
+        return {
+            "connections": len(self.senders),
+            "chats": len(self.active_connections),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_frames": self.dropped_frames + sum(sender.dropped_frames for sender in self.senders.values()),
+            "overflow_policy": self.overflow_policy,
+        }
 
-    
\ No newline at end of file
+    async def close(self) -> None:
+        await self.pubsub_client.close()
@@ -0,0 +1,323 @@
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable
+from uuid import uuid4
+import redis
+
+
+# a staged record carries an id so the exact entry can be removed once it's written
+def _stage_payload(record: dict) -> str:
+    return json.dumps({"id": uuid4().hex, "record": record})
+
+
+# records staged before they carried an id are the bare record
+def _staged_record(payload) -> dict:
+    data = json.loads(payload)
+
+    if isinstance(data, dict) and data.keys() == {"id", "record"}:
+        return data["record"]
+
+    return data
+
+
+# batches writes that nobody waits for (process logs, chat messages) into bulk writes done by a background thread
+# with a redis client the records are staged in a redis list until they're written, so a crash doesn't lose them
+# the writer gets a batch in order and returns how many records from the start of it were written
+# the queue holds (seq, staged payload, record), the payload is None for a record that couldn't be staged
+# add returns the record's seq and flush(upto=seq) waits for just the caller's records, not everything queued behind them
+# a record that keeps failing on its own is moved to a dead letter list so it doesn't hold up the records behind it
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        name: str,
+        writer: Callable[[list[dict]], int],
+        redis_client: redis.Redis | None = None,
+        flush_interval: float | None = None,
+        max_batch: int | None = None,
+        consumer_name: str | None = None,
+        max_attempts: int | None = None,
+        on_dead_letter: Callable[[dict], None] | None = None,
+    ):
+        self.name = name
+        self.writer = writer
+        self.r = redis_client
+
+        self.flush_interval = flush_interval or float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 0.2))
+        self.max_batch = max_batch or int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 100))
+
+        # the staging list belongs to this process, a restarted container gets the same name and picks its list back up
+        self.consumer_name = consumer_name or f"{socket.gethostname()}-{os.getpid()}"
+        self.staging_key = f"write_behind:{name}:{self.consumer_name}"
+        self.alive_key = f"write_behind_alive:{name}:{self.consumer_name}"
+        self.alive_ttl = int(os.getenv("WRITE_BEHIND_ALIVE_TTL", 30))
+        # how often we look for the staging lists of processes that died while we're running
+        self.recover_interval = float(os.getenv("WRITE_BEHIND_RECOVER_INTERVAL", self.alive_ttl))
+
+        # failed writes of a record on its own before it's dead lettered
+        self.max_attempts = max_attempts or int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 5))
+        self.dead_letter_key = f"write_behind_dead:{name}"
+        self.on_dead_letter = on_dead_letter
+        # used when there's no redis
+        self.dead_letters = []
+        # id of a queued record -> failed attempts
+        self.attempts = {}
+
+        self.queue = deque()
+        # seq of the last record added and of the last one done with (records are done in seq order)
+        # recovered records get 0, nobody waits for them
+        self.added_seq = 0
+        self.done_seq = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.idle = threading.Condition(self.lock)
+        self.writing = 0
+
+        self.thread = None
+        self.heartbeat_thread = None
+        self.stopped = False
+        self.failures = 0
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            # records this process staged before a restart go first, before anything new is staged
+            if self.r is not None:
+                try:
+                    own = self.r.lrange(self.staging_key, 0, -1)
+                except Exception as e:
+                    print(f"write behind {self.name} couldn't read {self.staging_key}: {e}")
+                    own = []
+
+                if own:
+                    print(f"write behind {self.name} recovering {len(own)} staged records")
+                    self.queue.extend((0, payload, _staged_record(payload)) for payload in own)
+
+            # on its own thread so a writer sleeping in backoff (or stuck on the database) still looks alive
+            if self.r is not None:
+                self._heartbeat()
+                self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name=f"write-behind-alive-{self.name}", daemon=True)
+                self.heartbeat_thread.start()
+
+            self.thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+            self.thread.start()
+
+    # never waits on the database, only on redis when staging is on
+    # returns the seq to pass to flush to wait for this record
+    def add(self, record: dict) -> int:
+        if self.thread is None:
+            self._start()
+
+        # staged and queued under the lock so the staging list and the queue have the same order
+        with self.lock:
+            payload = None
+
+            if self.r is not None:
+                try:
+                    payload = _stage_payload(record)
+                    self.r.rpush(self.staging_key, payload)
+                except Exception as e:
+                    # still written, just not crash safe
+                    print(f"write behind couldn't stage a {self.name} record: {e}")
+                    payload = None
+
+            self.added_seq += 1
+            seq = self.added_seq
+
+            self.queue.append((seq, payload, record))
+            full = len(self.queue) >= self.max_batch
+
+        if full:
+            self.wake.set()
+
+        return seq
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.queue) + self.writing
+
+    # wait until the records up to seq are written (or dead lettered), everything added so far without one
+    # a task passes the seq of its last record, on shutdown everything is flushed
+    def flush(self, timeout: float | None = None, upto: int | None = None) -> bool:
+        if self.thread is None:
+            return True
+
+        self.wake.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.lock:
+            target = self.added_seq if upto is None else upto
+
+            while self.done_seq < target or (upto is None and (self.queue or self.writing)):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                self.idle.wait(remaining)
+
+        return True
+
+    def stop(self, timeout: float | None = None):
+        self.flush(timeout)
+        self.stopped = True
+        self.wake.set()
+
+    def _run(self):
+        next_recover = 0
+
+        while not self.stopped:
+            # processes can die while we're running, their lists are picked up once their alive key expires
+            if self.r is not None and time.monotonic() >= next_recover:
+                self._recover()
+                next_recover = time.monotonic() + self.recover_interval
+
+            while self._write_batch():
+                pass
+
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+
+    def _heartbeat_loop(self):
+        while not self.stopped:
+            time.sleep(self.alive_ttl / 3)
+            self._heartbeat()
+
+    # returns how many records from the start of the batch are done with, written or dead lettered
+    def _write(self, batch: list[dict]) -> int:
+        try:
+            done = self.writer(batch)
+        except Exception as e:
+            print(f"write behind {self.name} failed: {e}")
+            done = 0
+
+        if done == len(batch):
+            return done
+
+        # a bulk write fails as a whole, the rest go one at a time to find the record that fails
+        for record in batch[done:]:
+            try:
+                if self.writer([record]) == 1:
+                    done += 1
+                    continue
+            except Exception as e:
+                print(f"write behind {self.name} failed on a single record: {e}")
+
+            attempts = self.attempts.get(id(record), 0) + 1
+            if attempts < self.max_attempts:
+                self.attempts[id(record)] = attempts
+                break
+
+            self._dead_letter(record)
+            done += 1
+
+        return done
+
+    # kept (in redis when there is one) so the record can be looked at and written by hand
+    def _dead_letter(self, record: dict):
+        print(f"write behind {self.name} gave up on a record after {self.max_attempts} attempts: {record}")
+
+        if self.r is not None:
+            try:
+                self.r.rpush(self.dead_letter_key, json.dumps(record))
+            except Exception as e:
+                print(f"write behind couldn't dead letter a {self.name} record: {e}")
+                self.dead_letters.append(record)
+        else:
+            self.dead_letters.append(record)
+
+        if self.on_dead_letter is not None:
+            try:
+                self.on_dead_letter(record)
+            except Exception as e:
+                print(f"write behind {self.name} dead letter callback failed: {e}")
+
+    # other processes leave our staging list alone while this key exists
+    def _heartbeat(self):
+        try:
+            self.r.set(self.alive_key, 1, ex=self.alive_ttl)
+        except Exception as e:
+            print(f"write behind heartbeat failed: {e}")
+
+    # returns True if there may be more to write straight away
+    def _write_batch(self) -> bool:
+        with self.lock:
+            entries = [self.queue[i] for i in range(min(self.max_batch, len(self.queue)))]
+            self.writing = len(entries)
+
+        if not entries:
+            return False
+
+        batch = [record for _, _, record in entries]
+        done = self._write(batch)
+
+        with self.lock:
+            for _ in range(done):
+                seq, _, record = self.queue.popleft()
+                self.attempts.pop(id(record), None)
+                self.done_seq = max(self.done_seq, seq)
+            self.writing = 0
+            self.idle.notify_all()
+
+        # remove exactly the staged entries that are done, the list can hold records the queue doesn't have in this order
+        staged = [payload for _, payload, _ in entries[:done] if payload is not None]
+        if staged:
+            try:
+                pipe = self.r.pipeline()
+                for payload in staged:
+                    pipe.lrem(self.staging_key, 1, payload)
+                pipe.execute()
+            except Exception as e:
+                print(f"write behind couldn't unstage written {self.name} records: {e}")
+
+        if done < len(batch):
+            # back off, the records stay queued (and staged) for the next attempt
+            self.failures += 1
+            time.sleep(min(self.flush_interval * 2 ** self.failures, 30))
+            return False
+
+        self.failures = 0
+        return True
+
+    # write the records staged by processes that died
+    def _recover(self):
+        try:
+            for key in self.r.scan_iter(match=f"write_behind:{self.name}:*"):
+                key = key.decode("utf-8")
+                consumer = key.rsplit(":", 1)[1]
+
+                if key == self.staging_key or self.r.exists(f"write_behind_alive:{self.name}:{consumer}"):
+                    continue
+
+                self._recover_orphan(key)
+        except Exception as e:
+            print(f"write behind {self.name} recovery failed: {e}")
+
+    # take over the staged records of a dead process, the rename makes sure only one process takes them
+    # they go in front of this process's own records and get the same retries and dead lettering
+    def _recover_orphan(self, key: str):
+        claimed = f"{key}:recovering:{self.consumer_name}"
+
+        try:
+            self.r.rename(key, claimed)
+        except redis.ResponseError:
+            # someone else got it first
+            return
+
+        staged = self.r.lrange(claimed, 0, -1)
+        print(f"write behind {self.name} recovering {len(staged)} records from {key}")
+
+        if staged:
+            with self.lock:
+                pipe = self.r.pipeline()
+                pipe.lpush(self.staging_key, *reversed(staged))
+                pipe.delete(claimed)
+                pipe.execute()
+
+                self.queue.extendleft((0, payload, _staged_record(payload)) for payload in reversed(staged))
+        else:
+            self.r.delete(claimed)
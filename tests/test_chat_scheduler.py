@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from app.services.orchestrator.chat_scheduler import ChatScheduler
+from app.utils.task_queue import OrchestratorStreamConsumer, dispatch_orchestrator_task
+
+
+# a task that waits behind a long task of its chat for longer than the visibility timeout
+# must keep its claim and run exactly once
+def test_waiting_task_runs_once_behind_a_long_task(monkeypatch):
+    monkeypatch.setenv("ORCHESTRATOR_VISIBILITY_TIMEOUT_MS", "300")
+    monkeypatch.setenv("ORCHESTRATOR_MAX_DELIVERIES", "3")
+
+    async def main():
+        r = fakeredis.FakeAsyncRedis()
+        consumer = OrchestratorStreamConsumer(r, consumer_name="worker")
+        await consumer.setup()
+
+        scheduler = ChatScheduler(consumer, concurrency=4)
+        executions = []
+
+        await dispatch_orchestrator_task(r, '{"chat_id": "chat", "task_id": "t0"}')
+        await dispatch_orchestrator_task(r, '{"chat_id": "chat", "task_id": "t1"}')
+
+        async def read_loop():
+            while True:
+                # fakeredis blocks the whole event loop on a blocking read, poll instead
+                item = await consumer.read(block_ms=None)
+                if item is None:
+                    await asyncio.sleep(0.02)
+                    continue
+
+                entry_id, raw_data, chat_id, seq = item
+
+                async def job(entry_id=entry_id, raw_data=raw_data, chat_id=chat_id, seq=seq):
+                    executions.append(raw_data)
+                    if b"t0" in raw_data:
+                        await asyncio.sleep(1.5)
+                    await consumer.ack(entry_id, chat_id, seq)
+
+                scheduler.submit(chat_id, seq, job, entry_id)
+
+        reader = asyncio.create_task(read_loop())
+        await asyncio.sleep(2.5)
+        reader.cancel()
+        await scheduler.join(timeout=1)
+
+        assert [b"t0" in raw for raw in executions] == [True, False]
+        assert await r.xlen(consumer.dead_letter_stream) == 0
+        assert not scheduler.heartbeats
+
+    asyncio.run(main())